@@ -0,0 +1,62 @@
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from renogybt.RoverClient import CHARGING_INFO, CHARGING_STATE, FUNCTION, LOAD_STATE
+from renogybt.Utils import bytes_to_int, crc16_modbus
+
+# Compares the compiled struct decoder with the per-field bytes_to_int path on a
+# Rover charging info response (register 256, 34 words).
+# Usage: python3 benchmarks/decoder_benchmark.py [iterations]
+
+
+def charging_info_frame():
+    body = bytes((i * 7 + 3) % 256 for i in range(68))
+    frame = bytes([255, 3, len(body)]) + body
+    return frame + crc16_modbus(frame)
+
+
+def parse_per_field(bs):
+    data = {}
+    data["function"] = FUNCTION.get(bytes_to_int(bs, 1, 1))
+    data["battery_percentage"] = bytes_to_int(bs, 3, 2)
+    data["battery_voltage"] = bytes_to_int(bs, 5, 2, scale=0.1)
+    data["battery_current"] = bytes_to_int(bs, 7, 2, scale=0.01)
+    data["battery_temperature"] = bytes_to_int(bs, 10, 1)
+    data["controller_temperature"] = bytes_to_int(bs, 9, 1)
+    data["load_status"] = LOAD_STATE.get(bytes_to_int(bs, 67, 1) >> 7)
+    data["load_voltage"] = bytes_to_int(bs, 11, 2, scale=0.1)
+    data["load_current"] = bytes_to_int(bs, 13, 2, scale=0.01)
+    data["load_power"] = bytes_to_int(bs, 15, 2)
+    data["pv_voltage"] = bytes_to_int(bs, 17, 2, scale=0.1)
+    data["pv_current"] = bytes_to_int(bs, 19, 2, scale=0.01)
+    data["pv_power"] = bytes_to_int(bs, 21, 2)
+    data["max_charging_power_today"] = bytes_to_int(bs, 33, 2)
+    data["max_discharging_power_today"] = bytes_to_int(bs, 35, 2)
+    data["charging_amp_hours_today"] = bytes_to_int(bs, 37, 2)
+    data["discharging_amp_hours_today"] = bytes_to_int(bs, 39, 2)
+    data["power_generation_today"] = bytes_to_int(bs, 41, 2)
+    data["power_consumption_today"] = bytes_to_int(bs, 43, 2)
+    data["power_generation_total"] = bytes_to_int(bs, 59, 4)
+    data["charging_status"] = CHARGING_STATE.get(bytes_to_int(bs, 68, 1))
+    return data
+
+
+def parse_compiled(bs):
+    data = CHARGING_INFO.decode(memoryview(bs))
+    data["load_status"] = LOAD_STATE.get(data["load_status"] >> 7)
+    return data
+
+
+if __name__ == "__main__":
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    frame = charging_info_frame()
+    assert parse_per_field(frame) == parse_compiled(frame), "decoders disagree"
+
+    per_field = timeit.timeit(lambda: parse_per_field(frame), number=iterations)
+    compiled = timeit.timeit(lambda: parse_compiled(frame), number=iterations)
+    print(f"per-field bytes_to_int: {per_field / iterations * 1e6:.2f} us/section")
+    print(f"compiled struct:        {compiled / iterations * 1e6:.2f} us/section")
+    print(f"speedup:                {per_field / compiled:.1f}x")
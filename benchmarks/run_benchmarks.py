@@ -0,0 +1,383 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import statistics
+import sys
+import time
+from functools import partial
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiohttp import web
+from renogybt import (
+    BatteryClient,
+    DataLogger,
+    InverterClient,
+    RoverClient,
+    RoverHistoryClient,
+    SimulatorBackend,
+)
+from renogybt.BaseClient import BaseClient
+from renogybt.ReadPlanner import split_response
+from renogybt.Utils import bytes_to_int, crc16_modbus
+
+# Benchmark suite for the polling stack, runs without radio or network: Modbus
+# helpers, client parsers on simulated frames, DataLogger payload building, and
+# full polls against the in-process simulator with MQTT/HTTP sinks stubbed
+# locally. Results are written as json and compared against a baseline recorded
+# on the target hardware; a benchmark slower than baseline * (1 + threshold)
+# fails the run (exit code 1).
+# Usage: python3 benchmarks/run_benchmarks.py [--quick] [--output results.json]
+#        [--baseline benchmarks/baseline.json] [--save-baseline] [--threshold 0.25]
+#        [--groups micro,parsers,payloads,polls,sinks]
+# Record the baseline on the device itself (e.g. the Pi), timings do not transfer
+# between machines. A baseline entry may carry its own "threshold".
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), "baseline.json")
+DEFAULT_THRESHOLD = 0.25  # allowed slowdown vs the baseline median
+REPEAT = 5
+
+CLIENTS = {
+    "RNG_CTRL": RoverClient,
+    "RNG_CTRL_HIST": RoverHistoryClient,
+    "RNG_BATT": BatteryClient,
+    "RNG_INVT": InverterClient,
+}
+
+SAMPLE_READING = {
+    "function": "READ",
+    "model": "RNG-CTRL-RVR40",
+    "device_id": 1,
+    "battery_percentage": 87,
+    "battery_voltage": 13.2,
+    "battery_current": 5.3,
+    "battery_temperature": 25,
+    "controller_temperature": 31,
+    "load_status": "off",
+    "load_voltage": 0.0,
+    "load_current": 0.0,
+    "load_power": 0,
+    "pv_voltage": 18.4,
+    "pv_current": 3.8,
+    "pv_power": 70,
+    "max_charging_power_today": 212,
+    "max_discharging_power_today": 0,
+    "charging_amp_hours_today": 24,
+    "discharging_amp_hours_today": 2,
+    "power_generation_today": 318,
+    "power_consumption_today": 12,
+    "power_generation_total": 51367,
+    "charging_status": "mppt",
+    "battery_type": "lithium",
+    "__device": "BT-TH-BENCH",
+    "__client": "RoverClient",
+}
+
+
+class MqttStub:
+    def __init__(self):
+        self.messages = 0
+
+    async def publish(self, topic, payload=None, qos=0, retain=False):
+        self.messages += 1
+
+
+def base_config(backend=None, **data):
+    return {
+        "data": {
+            "temperature_unit": "C",
+            "enable_polling": False,
+            "poll_interval": 60,
+            "fields": "",
+            **data,
+        },
+        "remote_logging": {"enabled": False, "url": "", "auth_header": ""},
+        "mqtt": {"enabled": False, "discovery_registry": ""},
+        "pvoutput": {"enabled": False, "api_key": "", "system_id": ""},
+        "backend": backend,
+        "links": {},
+        "lock": asyncio.Lock(),
+    }
+
+
+def device_config(device_type, mac_addr="5A:00:00:00:FF:FF", device_id=255):
+    return {
+        "alias": "BT-TH-BENCH",
+        "mac_addr": mac_addr,
+        "type": device_type,
+        "device_id": device_id,
+        "min_request_gap": 0,
+    }
+
+
+# (ops per run, callable) => per-op seconds of every run
+def measure(fn, number):
+    runs = []
+    for _ in range(REPEAT):
+        started = time.perf_counter()
+        for _ in range(number):
+            fn()
+        runs.append((time.perf_counter() - started) / number)
+    return runs
+
+
+async def measure_async(fn, number):
+    runs = []
+    for _ in range(REPEAT):
+        started = time.perf_counter()
+        for _ in range(number):
+            await fn()
+        runs.append((time.perf_counter() - started) / number)
+    return runs
+
+
+def summary(runs):
+    return {
+        "unit": "us",
+        "median": round(statistics.median(runs) * 1e6, 3),
+        "min": round(min(runs) * 1e6, 3),
+        "runs": len(runs),
+    }
+
+
+# Section frames as the simulator answers them, for the parser benchmarks
+def section_frames(client, backend):
+    module = next(iter(backend.modules.values()))
+    frames = []
+    for section in client.sections:
+        request = client.create_generic_read_request(
+            client.device_id, 3, section["register"], section["words"]
+        )
+        response = module.respond(bytes(request))
+        read = {"register": section["register"], "sections": [(section, 0)]}
+        frames += split_response(read, response)
+    return frames
+
+
+def micro_benchmarks(scale):
+    request = bytes([255, 3, 1, 0, 0, 34])
+    frame = bytes(range(73))
+    create_request = BaseClient.create_generic_read_request
+    return {
+        "crc16_request": measure(lambda: crc16_modbus(request), 20000 * scale),
+        "crc16_frame": measure(lambda: crc16_modbus(frame), 5000 * scale),
+        "bytes_to_int": measure(lambda: bytes_to_int(frame, 59, 4), 50000 * scale),
+        "create_generic_read_request": measure(
+            lambda: create_request(None, 255, 3, 256, 34), 10000 * scale
+        ),
+    }
+
+
+def parser_benchmarks(scale):
+    results = {}
+    for device_type, client_class in CLIENTS.items():
+        backend = SimulatorBackend()
+        backend.populate(1, device_type)
+        client = client_class({**base_config(), "device": device_config(device_type)})
+        frames = section_frames(client, backend)
+
+        def parse_all(client=client, frames=frames):
+            for section, frame in frames:
+                section["parser"](frame)
+
+        results[f"parse_{device_type}"] = measure(parse_all, 2000 * scale)
+    return results
+
+
+def payload_benchmarks(scale):
+    data_logger = DataLogger(base_config())
+    entities = tuple(f for f in SAMPLE_READING if not f.startswith("__"))
+    topic = "renogy/RNG-CTRL-RVR40/BT-TH-BENCH"
+
+    def discovery():
+        data_logger.discovery_cache.clear()
+        data_logger.discovery_payloads("BT-TH-BENCH", "RNG-CTRL-RVR40", topic, entities)
+
+    delta_logger = DataLogger(
+        {**base_config(), "mqtt": {"publish_mode": "delta", "discovery_registry": ""}}
+    )
+
+    # steady state delta: diff, then commit as after a successful publish
+    def delta_messages():
+        messages, commit = delta_logger.mqtt_messages(topic, SAMPLE_READING)
+        commit()
+        return messages
+
+    return {
+        "state_json": measure(lambda: json.dumps(SAMPLE_READING), 5000 * scale),
+        "discovery_payloads": measure(discovery, 200 * scale),
+        "mqtt_delta_messages": measure(delta_messages, 5000 * scale),
+    }
+
+
+# every poll reads every section over the radio, nothing is held by the schedule
+POLL_DATA = {
+    "persistent_connection": True,
+    "poll_interval": 0,
+    "adaptive_polling": False,
+}
+
+
+# sections with their own interval (history) would be held after the first poll
+async def unscheduled_poll(client):
+    client.schedule.entries.clear()
+    return await client.poll()
+
+
+async def poll_benchmarks(scale):
+    results = {}
+    for device_type, client_class in CLIENTS.items():
+        backend = SimulatorBackend()
+        devices = backend.populate(1, device_type, latency=0, jitter=0)
+        config = base_config(backend, **POLL_DATA)
+        client = client_class(
+            {**config, "device": {**devices[0], "min_request_gap": 0}}
+        )
+        await client.poll()  # connect once, steady state polls reuse the link
+        results[f"poll_{device_type}"] = await measure_async(
+            partial(unscheduled_poll, client), 20 * scale
+        )
+        await client.stop()
+
+    # one cycle over 100 controllers with the links kept open
+    backend = SimulatorBackend()
+    devices = backend.populate(100, "RNG_CTRL", latency=0, jitter=0)
+    config = base_config(backend, **POLL_DATA)
+    clients = [
+        RoverClient({**config, "device": {**device, "min_request_gap": 0}})
+        for device in devices
+    ]
+
+    async def cycle():
+        await asyncio.gather(*[unscheduled_poll(client) for client in clients])
+
+    await cycle()
+    results["poll_cycle_100_rovers"] = await measure_async(cycle, 2 * scale)
+    for client in clients:
+        await client.stop()
+    return results
+
+
+async def sink_benchmarks(scale):
+    async def ok(request):
+        await request.read()
+        return web.Response(text="OK")
+
+    app = web.Application()
+    app.router.add_post("/{tail:.*}", ok)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+
+    config = base_config()
+    config["remote_logging"] = {
+        "enabled": False,
+        "url": f"http://127.0.0.1:{port}/log",
+        "auth_header": "bench",
+    }
+    data_logger = DataLogger(config)
+    await data_logger.start()
+    data_logger.set_mqtt_client(MqttStub())
+    try:
+        await data_logger.log_mqtt(dict(SAMPLE_READING))  # discovery once
+        assert await data_logger.log_remote(SAMPLE_READING), "http stub failed"
+        return {
+            "log_remote_http": await measure_async(
+                lambda: data_logger.log_remote(SAMPLE_READING), 50 * scale
+            ),
+            "log_mqtt": await measure_async(
+                lambda: data_logger.log_mqtt(SAMPLE_READING), 500 * scale
+            ),
+        }
+    finally:
+        await data_logger.close()
+        await runner.cleanup()
+
+
+GROUPS = {
+    "micro": micro_benchmarks,
+    "parsers": parser_benchmarks,
+    "payloads": payload_benchmarks,
+    "polls": poll_benchmarks,
+    "sinks": sink_benchmarks,
+}
+
+
+async def run(scale, groups):
+    results = {}
+    for group in groups:
+        runs = GROUPS[group](scale)
+        if asyncio.iscoroutine(runs):
+            runs = await runs
+        for name, timings in runs.items():
+            results[name] = summary(timings)
+    return results
+
+
+# Names of the benchmarks slower than their baseline by more than the threshold
+def regressions(results, baseline, threshold):
+    slower = []
+    for name, reference in baseline.get("results", {}).items():
+        current = results.get(name)
+        if current is None:
+            continue
+        limit = reference.get("threshold", threshold)
+        ratio = current["median"] / reference["median"] if reference["median"] else 1
+        status = "REGRESSION" if ratio > 1 + limit else "ok"
+        print(f"{name:32} {current['median']:12.3f} us  x{ratio:.2f}  {status}")
+        if ratio > 1 + limit:
+            slower.append(name)
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(description="renogy-bt benchmarks")
+    parser.add_argument("--quick", action="store_true", help="fewer iterations")
+    parser.add_argument("--output", help="write the results to this json file")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD)
+    parser.add_argument(
+        "--groups",
+        default=",".join(GROUPS),
+        help=f"comma separated subset of {', '.join(GROUPS)}",
+    )
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+
+    results = asyncio.run(run(1 if args.quick else 5, args.groups.split(",")))
+    report = {
+        "meta": {
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "node": platform.node(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+    elif os.path.isfile(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        slower = regressions(results, baseline, args.threshold)
+        if slower:
+            print(f"{len(slower)} benchmarks regressed: {', '.join(slower)}")
+            sys.exit(1)
+    else:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
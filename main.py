@@ -5,18 +5,27 @@ import json
 import logging
 import signal
 from datetime import datetime
+from functools import partial
 from os import access, R_OK
 from os.path import isfile
 from typing import Dict
 from renogybt import (
+    AdapterPool,
     InverterClient,
     RoverClient,
     RoverHistoryClient,
+    BankAggregator,
     BatteryClient,
     BLEManager,
     DataLogger,
+    EnergyIntegrator,
+    HistoryStore,
+    MetricsServer,
+    SectionCache,
+    TimeSeriesStore,
     Utils,
 )
+from renogybt.Metrics import REGISTRY
 
 
 def load_user_config():
@@ -46,8 +55,42 @@ config["data"]["enable_polling"] = False
 # Set up remote logging
 data_logger: DataLogger = DataLogger(config)
 
+# Prometheus endpoint / MQTT diagnostics device
+metrics_config = config.get("metrics", {})
+
+# Optional local history, one memory-mapped ring file per device
+timeseries_config = config.get("timeseries", {})
+timeseries = None
+if timeseries_config.get("enabled"):
+    timeseries = TimeSeriesStore(
+        path=timeseries_config.get("path", "timeseries"),
+        max_bytes=timeseries_config.get("max_bytes", 1048576),
+        flush_interval=timeseries_config.get("flush_interval", 60),
+    )
+
+# Optional energy integration, publishes minute/hour/day rollups as readings
+energy_config = config.get("energy", {})
+energy = None
+if energy_config.get("enabled"):
+    energy = EnergyIntegrator(
+        max_gap=energy_config.get(
+            "max_gap", max(600, 3 * config["data"]["poll_interval"])
+        ),
+        publish=energy_config.get("publish", ["hour", "day"]),
+    )
+
+# Optional battery bank analytics, one 'bank' reading per cycle
+bank_config = config.get("bank", {})
+bank = None
+if bank_config.get("enabled"):
+    bank = BankAggregator(
+        trend_window=bank_config.get("trend_window", 30),
+        outlier_volts=bank_config.get("outlier_volts", 0.03),
+    )
+
 # Event to signal shutdown
 shutdown_event = asyncio.Event()
+MQTT_RECONNECT_DELAY = 5  # (seconds)
 
 
 def shutdown():
@@ -56,24 +99,42 @@ def shutdown():
 
 
 async def poll_devices(config):
-    config["lock"] = asyncio.Lock()
+    # one scanner (which also serializes connects) and scheduler per bluetooth adapter
+    pool = AdapterPool(
+        config,
+        adapters=config["data"].get("adapters"),
+        max_concurrency=config["data"].get("max_concurrent_polls", 4),
+        deadline=config["data"].get("device_deadline", 60),
+    )
+    config["links"] = {}  # BT module MAC => BLEManager shared by its hub devices
+    config["section_cache"] = SectionCache(
+        path=config["data"].get("static_cache_file", "section_cache.json"),
+        ttl=config["data"].get("static_cache_ttl", 86400),
+    )
+    # daily history already synced, for devices with history_sync
+    config["history_store"] = HistoryStore(
+        path=config["data"].get("history_file", "rover_history.json"),
+        max_days=config["data"].get("history_max_days", 365),
+    )
+    clients = {}
 
     try:
+        await pool.start(BLEManager.DISCOVERY_TIMEOUT)
         while not shutdown_event.is_set():
-            for device in config["devices"]:
-                if not device.get("bleak_device"):
-                    await BLEManager.discover(config)
-                    break
+            # devices not seen yet are skipped, the scanners keep looking for them
+            for device in pool.missing():
+                logger.warning(f"{device['alias']} not found yet, skipping")
 
-            # tasks = [
-            #     start_client({**config, "device": device})
-            #     for device in config["devices"]
-            # ]
-            # await asyncio.gather(*tasks)
-
-            for device in config["devices"]:
-                await start_client({**config, "device": device})
-                logger.info(f"Polling complete for {device['alias']}")
+            await pool.run_cycle(
+                lambda device, lock: partial(
+                    poll_client, clients, {**config, "device": device, "lock": lock}
+                )
+            )
+            for reading in bank.readings() if bank else []:
+                logging.info(f"{reading['__device']} => {reading}")
+                publish(reading)
+            if config["mqtt"]["enabled"] and metrics_config.get("mqtt_diagnostics"):
+                data_logger.enqueue("mqtt", REGISTRY.diagnostics())
 
             try:
                 logger.info(f"Sleeping for {config['data']['poll_interval']}")
@@ -84,50 +145,130 @@ async def poll_devices(config):
                 pass
     except Exception as e:
         logging.error(f"Error in main loop: {e}")
+    finally:
+        for client in clients.values():
+            await client.stop()
+        await pool.stop()
 
 
 # The callback function when data is received
 async def on_data_received(client, data):
     filtered_data = Utils.filter_fields(data, config["data"]["fields"])
     logging.info(f"{client.bleManager.device.name} => {filtered_data}")
+    if timeseries:
+        timeseries.append(filtered_data, client.reading_class)
+    publish(filtered_data)
+    if config["pvoutput"]["enabled"] and client.config["device"]["type"] == "RNG_CTRL":
+        data_logger.enqueue("pvoutput", filtered_data)
+    if bank and client.config["device"]["type"] == "RNG_BATT":
+        bank.update(data, client.config["device"].get("bank", "battery-bank"))
+    if energy:
+        # integrated from the unfiltered reading, the power fields are needed
+        for reading in energy.update(data):
+            logging.info(f"{reading['__device']} => {reading}")
+            publish(reading)
+
+
+# sinks deliver in the background, the BLE path only enqueues
+def publish(data):
     if config["remote_logging"]["enabled"]:
-        await data_logger.log_remote(json_data=filtered_data)
+        data_logger.enqueue("remote", data)
     if config["mqtt"]["enabled"]:
-        await data_logger.log_mqtt(json_data=filtered_data)
-    if config["pvoutput"]["enabled"] and config["device"]["type"] == "RNG_CTRL":
-        await data_logger.log_pvoutput(json_data=filtered_data)
-    await client.stop()
+        data_logger.enqueue("mqtt", data)
 
 
-# Start client
-async def start_client(device_config):
+def create_client(device_config):
     logger.info(f"Device alias: {device_config['device']['alias']}")
     logger.info(f"Device type: {device_config['device']['type']}")
     if device_config["device"]["type"] == "RNG_CTRL":
-        await RoverClient(device_config, on_data_received).start()
+        return RoverClient(device_config, on_data_received)
     elif device_config["device"]["type"] == "RNG_CTRL_HIST":
-        await RoverHistoryClient(device_config, on_data_received).start()
+        return RoverHistoryClient(device_config, on_data_received)
     elif device_config["device"]["type"] == "RNG_BATT":
-        await BatteryClient(device_config, on_data_received).start()
+        return BatteryClient(device_config, on_data_received)
     elif device_config["device"]["type"] == "RNG_INVT":
-        await InverterClient(device_config, on_data_received).start()
+        return InverterClient(device_config, on_data_received)
     else:
         logging.error("unknown device type")
 
 
+# Poll a device once. In persistent mode the client (and its BLE session) is
+# created on first use and reused, otherwise it is disconnected after the read.
+async def poll_client(clients, device_config):
+    alias = device_config["device"]["alias"]
+    client = clients.get(alias) or create_client(device_config)
+    if client is None:
+        return
+    if not client.is_due():  # adaptive polling: every section is still fresh
+        clients[alias] = client
+        return logger.info(f"{alias} skipped, no section due")
+    try:
+        await client.poll()
+    finally:
+        if client.persistent:
+            clients[alias] = client
+        else:
+            await client.stop()
+    timings = client.timings
+    logger.info(
+        f"{alias} polled: connects={timings['connects']} "
+        f"last_connect={timings['connect_time']:.2f}s read={timings['read_time']:.2f}s"
+    )
+
+
+# Keeps the MQTT connection up, aiomqtt does not reconnect by itself. While it
+# is down the MQTT sink fails over to its spool, replayed once reconnected.
+async def mqtt_connection():
+    while not shutdown_event.is_set():
+        try:
+            async with aiomqtt.Client(
+                config["mqtt"]["server"],
+                port=config["mqtt"]["port"],
+                username=config["mqtt"]["user"],
+                password=config["mqtt"]["password"],
+                identifier="renogy-bt",
+            ) as mqtt_client:
+                logger.info("MQTT connected")
+                data_logger.set_mqtt_client(mqtt_client)
+                # nothing is subscribed, the iteration only ends on a disconnect
+                async for _ in mqtt_client.messages:
+                    pass
+        except aiomqtt.MqttError as e:
+            logger.error(f"MQTT connection lost: {e}")
+        finally:
+            data_logger.set_mqtt_client(None)
+        try:
+            await asyncio.wait_for(
+                shutdown_event.wait(),
+                timeout=config["mqtt"].get("reconnect_delay", MQTT_RECONNECT_DELAY),
+            )
+        except TimeoutError:
+            pass
+
+
 async def main():
+    await data_logger.start()
+    metrics_server = None
+    if metrics_config.get("enabled"):
+        metrics_server = MetricsServer(
+            host=metrics_config.get("host", "127.0.0.1"),
+            port=metrics_config.get("port", 9091),
+        )
+        await metrics_server.start()
+    mqtt_task = None
     if config["mqtt"]["enabled"]:
-        async with aiomqtt.Client(
-            config["mqtt"]["server"],
-            port=config["mqtt"]["port"],
-            username=config["mqtt"]["user"],
-            password=config["mqtt"]["password"],
-            identifier="renogy-bt",
-        ) as mqtt_client:
-            data_logger.set_mqtt_client(mqtt_client)
-            await poll_devices(config)
-    else:
+        mqtt_task = asyncio.create_task(mqtt_connection())
+    try:
         await poll_devices(config)
+    finally:
+        if mqtt_task:
+            mqtt_task.cancel()
+            await asyncio.gather(mqtt_task, return_exceptions=True)
+        if metrics_server:
+            await metrics_server.stop()
+        await data_logger.close()
+        if timeseries:
+            timeseries.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,128 @@
+import asyncio
+import logging
+from .DeviceScanner import DeviceScanner
+from .PollScheduler import PollScheduler, DEFAULT_MAX_CONCURRENCY, DEFAULT_DEADLINE
+
+# Shards devices across several bluetooth controllers (hci0, hci1...). Every
+# adapter gets its own scanner (which is also its connect lock) and its own
+# poll scheduler, so connection setup and polling on one adapter never wait for
+# another. A device is pinned with 'adapter' in its config, otherwise it goes to
+# the adapter that hears it with the best RSSI. With no adapters configured the
+# pool holds a single shard on the system default adapter.
+
+
+class AdapterShard:
+    def __init__(self, config, adapter, backend, max_concurrency, deadline):
+        self.adapter = adapter
+        self.devices = []  # config devices polled through this adapter
+        self.scanner = DeviceScanner(
+            config, devices=self.devices, adapter=adapter, backend=backend
+        )
+        self.scheduler = PollScheduler(max_concurrency, deadline)
+
+
+class AdapterPool:
+    def __init__(
+        self,
+        config,
+        adapters=None,
+        backend=None,
+        max_concurrency=DEFAULT_MAX_CONCURRENCY,
+        deadline=DEFAULT_DEADLINE,
+    ):
+        self.config = config
+        backend = backend or config.get("backend")
+        self.shards = {
+            adapter: AdapterShard(config, adapter, backend, max_concurrency, deadline)
+            for adapter in (adapters or [None])
+        }
+        self.unassigned = []  # devices waiting to be heard by any adapter
+        for device in config["devices"]:
+            adapter = device.get("adapter")
+            if adapter is None and len(self.shards) == 1:
+                adapter = next(iter(self.shards))
+            if adapter in self.shards:
+                self.__assign(device, adapter)
+            else:
+                if adapter is not None:
+                    logging.warning(
+                        f"{device['alias']}: unknown adapter {adapter}, assigning by RSSI"
+                    )
+                self.unassigned.append(device)
+
+    async def start(self, timeout):
+        for shard in self.shards.values():
+            await shard.scanner.start()
+        await asyncio.gather(
+            *[s.scanner.wait_for_devices(timeout) for s in self.shards.values()],
+            self.__wait_for_unassigned(timeout),
+        )
+        self.assign()
+
+    async def stop(self):
+        for shard in self.shards.values():
+            await shard.scanner.stop()
+
+    # Moves every device heard by at least one adapter to the one with the best RSSI
+    def assign(self):
+        for device in list(self.unassigned):
+            best = None
+            for adapter, shard in self.shards.items():
+                entry = shard.scanner.lookup(device)
+                if entry and (best is None or entry["rssi"] > best[1]["rssi"]):
+                    best = (adapter, entry)
+            if best is None:
+                continue
+            adapter, entry = best
+            self.unassigned.remove(device)
+            device["bleak_device"] = entry["device"]
+            self.__assign(device, adapter)
+            logging.info(
+                f"{device['alias']} assigned to adapter {adapter or 'default'} "
+                f"(rssi {entry['rssi']})"
+            )
+
+    def missing(self):
+        missing = list(self.unassigned)
+        for shard in self.shards.values():
+            missing += shard.scanner.missing()
+        return missing
+
+    # job_factory(device, lock) returns the coroutine function polling that device
+    async def run_cycle(self, job_factory):
+        for shard in self.shards.values():
+            shard.scanner.expire_stale()
+        self.assign()
+        results = await asyncio.gather(
+            *[
+                shard.scheduler.run_cycle(
+                    [
+                        (
+                            device["alias"],
+                            job_factory(device, shard.scanner),
+                            device.get("deadline"),
+                        )
+                        for device in shard.devices
+                        if device.get("bleak_device")
+                    ]
+                )
+                for shard in self.shards.values()
+                if shard.devices
+            ]
+        )
+        return {name: r for result in results for name, r in result.items()}
+
+    def __assign(self, device, adapter):
+        device["adapter"] = adapter
+        self.shards[adapter].devices.append(device)
+
+    async def __wait_for_unassigned(self, timeout):
+        loop = asyncio.get_running_loop()
+        end = loop.time() + timeout
+        while loop.time() < end:
+            if all(
+                any(s.scanner.lookup(d) for s in self.shards.values())
+                for d in self.unassigned
+            ):
+                return
+            await asyncio.sleep(0.2)
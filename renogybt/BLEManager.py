@@ -3,25 +3,40 @@ import logging
 import contextlib
 import time
 from bleak import BleakClient, BleakScanner, BLEDevice
+from .FrameAssembler import FrameAssembler
+from .Metrics import (
+    CONNECT_FAILURES,
+    CONNECT_SECONDS,
+    CRC_ERRORS,
+    LINK_DROPS,
+    RESYNCS,
+    SERVICES_SECONDS,
+)
 
 DISCOVERY_TIMEOUT = 5  # max wait time to complete the bluetooth scanning (seconds)
+RECONNECT_MIN_DELAY = 2  # first backoff after a dropped link (seconds)
+RECONNECT_MAX_DELAY = 120  # backoff ceiling for a device that keeps failing (seconds)
 
 
-async def discover(config):
-    lock = config["lock"]
-    async with lock:
-        logging.info("Starting discovery...")
-        discovered_devices = await BleakScanner.discover(timeout=5)
-        logging.info(f"Devices found: {len(discovered_devices)}")
+# Creates the bleak objects for an adapter (e.g. "hci1", None for the default one).
+# Swap in another backend to run without a radio.
+class BleakBackend:
+    def create_client(self, device, adapter=None, disconnected_callback=None):
+        kwargs = {"adapter": adapter} if adapter else {}
+        return BleakClient(
+            device, disconnected_callback=disconnected_callback, **kwargs
+        )
 
-    for dev in discovered_devices:
-        for config_device in config["devices"]:
-            if dev.address != None and (
-                dev.address.upper() == config_device["mac_addr"]
-                or (dev.name and dev.name.strip() == config_device["alias"])
-            ):
-                logging.info(f"Found matching device {dev.name} => {dev.address}")
-                config_device["bleak_device"] = dev
+    def create_scanner(self, detection_callback, adapter=None):
+        kwargs = {"adapter": adapter} if adapter else {}
+        return BleakScanner(detection_callback=detection_callback, **kwargs)
+
+
+def matches_config(dev, config_device):
+    return dev.address != None and (
+        dev.address.upper() == config_device["mac_addr"]
+        or (dev.name and dev.name.strip() == config_device["alias"])
+    )
 
 
 class BLEManager:
@@ -34,18 +49,52 @@ class BLEManager:
         on_connect_fail,
         notify_uuid,
         write_uuid,
+        on_disconnect=None,
+        adapter=None,
+        backend=None,
     ):
         self.mac_address = mac_address
         self.device_alias = alias
         self.data_callback = on_data
         self.connect_fail_callback = on_connect_fail
+        self.disconnect_callback = on_disconnect
         self.notify_char_uuid = notify_uuid
         self.write_char_uuid = write_uuid
         self.device: BLEDevice = bleak_device
+        self.adapter = adapter
+        self.backend = backend or BleakBackend()
         self.client: BleakClient = None
         self.discovered_devices = []
+        self.assembler = FrameAssembler()
+        self.closing = False
+        self.connect_count = 0
+        self.connect_duration = 0  # duration of the last connect + subscribe (seconds)
+        self.reconnect_delay = 0
+        self.next_connect_at = 0
+        # Hub mode: several Modbus devices behind one BT module share this link.
+        # Frames are routed by their address byte, polls take turns on poll_lock.
+        self.listeners = {}  # device_id => (on_data, on_disconnect)
+        self.active_device_id = None
+        self.connect_guard = asyncio.Lock()
+        self.poll_lock = asyncio.Lock()
+
+    @property
+    def is_connected(self):
+        return self.client is not None and self.client.is_connected
+
+    def add_listener(self, device_id, on_data, on_disconnect=None):
+        self.listeners[device_id] = (on_data, on_disconnect)
+
+    # Returns True once no device uses the link anymore
+    def remove_listener(self, device_id, on_data):
+        listener = self.listeners.get(device_id)
+        if listener and listener[0] == on_data:
+            del self.listeners[device_id]
+        return not self.listeners
 
     async def connect(self, lock):
+        started = time.monotonic()
+        self.closing = False
         try:
             # Trying to establish a connection to two devices at the same time
             # can cause errors, so use a lock to avoid this.
@@ -53,11 +102,16 @@ class BLEManager:
                 if self.device is None:
                     logging.error(f"{self.device_alias} not found")
                     return
-                self.client = BleakClient(self.device)
+                self.client = self.backend.create_client(
+                    self.device,
+                    adapter=self.adapter,
+                    disconnected_callback=self.__on_disconnected,
+                )
                 logging.info(f"Connecting to {self.device_alias}")
                 await self.client.connect()
                 logging.info(f"Connected to {self.device_alias}")
 
+            services_started = time.monotonic()
             for service in self.client.services:
                 for characteristic in service.characteristics:
                     if characteristic.uuid == self.notify_char_uuid:
@@ -72,24 +126,92 @@ class BLEManager:
                             f"Found write characteristic {characteristic.uuid}"
                         )
 
+            self.connect_count += 1
+            self.connect_duration = time.monotonic() - started
+            SERVICES_SECONDS.observe(
+                time.monotonic() - services_started, device=self.device_alias
+            )
+            CONNECT_SECONDS.observe(self.connect_duration, device=self.device_alias)
+            self.reconnect_delay = 0
+            logging.info(
+                f"{self.device_alias} session ready in {self.connect_duration:.2f}s"
+            )
+
         except Exception as e:
             logging.error(f"Error connecting: {e}", exc_info=True)
+            CONNECT_FAILURES.inc(device=self.device_alias)
             self.connect_fail_callback(e)
 
+    # Keeps a long-lived session alive: reconnects only if the link dropped,
+    # backing off exponentially while the device keeps failing.
+    async def ensure_connected(self, lock):
+        if self.is_connected:
+            return True
+        # devices sharing the link wait for one connect instead of racing it
+        async with self.connect_guard:
+            if self.is_connected:
+                return True
+            remaining = self.next_connect_at - time.monotonic()
+            if remaining > 0:
+                logging.info(
+                    f"{self.device_alias} reconnect backing off, retry in {remaining:.0f}s"
+                )
+                return False
+            await self.connect(lock)
+            if not self.is_connected:
+                self.__schedule_reconnect()
+                return False
+            return True
+
+    def __schedule_reconnect(self):
+        self.reconnect_delay = min(
+            max(self.reconnect_delay * 2, RECONNECT_MIN_DELAY), RECONNECT_MAX_DELAY
+        )
+        self.next_connect_at = time.monotonic() + self.reconnect_delay
+
+    def __on_disconnected(self, client):
+        if self.closing:
+            return
+        logging.warning(f"{self.device_alias} link dropped")
+        LINK_DROPS.inc(device=self.device_alias)
+        listeners = list(self.listeners.values()) or [(None, self.disconnect_callback)]
+        for _, on_disconnect in listeners:
+            if on_disconnect:
+                on_disconnect()
+
     async def notification_callback(self, characteristic, data: bytearray):
         logging.debug("notification_callback")
-        await self.data_callback(data)
+        assembler = self.assembler
+        crc_errors, resyncs = assembler.crc_errors, assembler.resyncs
+        frames = assembler.feed(data)
+        if assembler.crc_errors != crc_errors:
+            CRC_ERRORS.inc(assembler.crc_errors - crc_errors, device=self.device_alias)
+        if assembler.resyncs != resyncs:
+            RESYNCS.inc(assembler.resyncs - resyncs, device=self.device_alias)
+        for frame in frames:
+            await self.__route(frame)(frame)
+
+    # Picks the receiver by the frame's address byte, falling back to the device
+    # that sent the last request (e.g. a 255 broadcast answered by the real id)
+    def __route(self, frame):
+        listener = self.listeners.get(frame[0]) or self.listeners.get(
+            self.active_device_id
+        )
+        return listener[0] if listener else self.data_callback
 
     async def characteristic_write_value(self, data):
         try:
+            # a new request starts a new exchange, leftovers are from a lost response
+            self.assembler.reset()
+            self.active_device_id = data[0]
             logging.debug(f"Writing to {self.write_char_uuid} {data}")
             await self.client.write_gatt_char(self.write_char_uuid, bytearray(data))
             logging.debug("Characteristic_write_value succeeded")
-            await asyncio.sleep(0.5)
         except Exception as e:
             logging.warning(f"Characteristic_write_value failed {e}")
 
     async def disconnect(self):
+        self.closing = True
         if self.client and self.client.is_connected:
             logging.info(
                 f"Exit: Disconnecting device: {self.device.name} {self.device.address}"
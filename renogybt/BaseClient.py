@@ -1,19 +1,53 @@
 import asyncio
 import logging
+import time
 from .BLEManager import BLEManager
+from .Metrics import CACHE_HITS, POLL_SECONDS, POLLS, READ_TIMEOUTS, RTT_SECONDS
+from .RequestPacer import MIN_REQUEST_GAP, RequestPacer
+from .SectionSchedule import DEFAULT_MAX_INTERVAL, SectionSchedule
+from .Readings import make_reading
+from .ReadPlanner import (
+    DEFAULT_MAX_GAP_WORDS,
+    DEFAULT_MAX_READ_WORDS,
+    plan_reads,
+    split_response,
+)
 from .Utils import bytes_to_int, crc16_modbus, int_to_bytes
 
 # Base class that works with all Renogy family devices
 # Should be extended by each client with its own parsers and section definitions
 # Section example: {'register': 5000, 'words': 8, 'parser': self.parser_func}
+# Neighbouring sections are coalesced into larger reads, see ReadPlanner
+# Sections marked 'static': True are served from config['section_cache'] if present
+# Sections that are not due yet are replayed from their last response, see SectionSchedule
 
 ALIAS_PREFIX = "BT-TH"
 NOTIFY_CHAR_UUID = "0000fff1-0000-1000-8000-00805f9b34fb"
 WRITE_CHAR_UUID = "0000ffd1-0000-1000-8000-00805f9b34fb"
-READ_TIMEOUT = 15  # (seconds)
+READ_TIMEOUT = 15  # upper bound, the actual timeout follows the measured RTT (seconds)
+READ_RETRIES = 2  # extra attempts for a read whose response got lost
+MAX_CONSECUTIVE_TIMEOUTS = 3  # reads in a row without response before giving up
+STREAM_BUFFER = 10  # readings stream() buffers before polling pauses
+
+# Per section quality flags in reading['__quality'] (register => flag)
+QUALITY_OK = "ok"
+QUALITY_CACHED = "cached"  # static section served from the section cache
+QUALITY_HELD = "held"  # not due yet, last response replayed (SectionSchedule)
+QUALITY_TIMEOUT = "timeout"
+QUALITY_EXCEPTION = "exception"  # device answered with a Modbus exception
+
+MODBUS_EXCEPTIONS = {
+    1: "illegal function",
+    2: "illegal data address",
+    3: "illegal data value",
+    4: "slave device failure",
+}
 
 
 class BaseClient:
+    # record type of stream(), overridden per device type (see Readings)
+    reading_class = make_reading("GenericReading")
+
     def __init__(self, config):
         self.config = config
         self.bleManager = None
@@ -23,8 +57,38 @@ class BaseClient:
         self.data = {}
         self.device_id = self.config["device"]["device_id"]
         self.sections = []
-        self.section_index = 0
+        self.reads = []
+        self.read_index = 0
+        self.read_attempt = 0
+        self.timeouts = 0  # consecutive reads that timed out after their retries
+        self.quality = {}  # register => quality flag of the running poll
+        # unused registers a client knows are safe to read between two sections
+        self.max_gap_words = DEFAULT_MAX_GAP_WORDS
+        self.cache = self.config.get("section_cache")
         self.loop = asyncio.get_event_loop()
+        # kept on the device entry so the RTT estimate survives per-cycle clients
+        self.pacer = self.config["device"].setdefault(
+            "pacer",
+            RequestPacer(
+                min_gap=self.config["device"].get("min_request_gap", MIN_REQUEST_GAP),
+                max_timeout=READ_TIMEOUT,
+            ),
+        )
+        self.schedule = self.config["device"].setdefault(
+            "schedule",
+            SectionSchedule(
+                base_interval=self.config["data"].get("poll_interval", 0),
+                adaptive=bool(self.config["data"].get("adaptive_polling", False)),
+                max_interval=self.config["data"].get(
+                    "max_section_interval", DEFAULT_MAX_INTERVAL
+                ),
+            ),
+        )
+        # Persistent mode keeps one BLE session open across polls, see poll()
+        self.persistent = bool(self.config["data"].get("persistent_connection", False))
+        self.poll_future = None
+        self.read_duration = 0
+        self.tasks = set()  # background tasks, referenced until they finish
         logging.info(
             f"Init {self.__class__.__name__}: {self.config['device']['alias']} => {self.config['device']['mac_addr']}"
         )
@@ -37,16 +101,34 @@ class BaseClient:
         except KeyboardInterrupt:
             self.__on_error("KeyboardInterrupt")
 
-    async def connect(self):
-        self.bleManager = BLEManager(
-            bleak_device=self.config["device"]["bleak_device"],
-            mac_address=self.config["device"]["mac_addr"],
-            alias=self.config["device"]["alias"],
-            on_data=self.on_data_received,
-            on_connect_fail=self.__on_connect_fail,
-            notify_uuid=NOTIFY_CHAR_UUID,
-            write_uuid=WRITE_CHAR_UUID,
+    def create_ble_manager(self):
+        # With config['links'] all clients of the same BT module (hub mode) share
+        # one BLEManager and therefore one connection
+        links = self.config.get("links")
+        mac_address = self.config["device"]["mac_addr"].upper()
+        manager = links.get(mac_address) if links is not None else None
+        if manager is None:
+            manager = BLEManager(
+                bleak_device=self.config["device"].get("bleak_device"),
+                mac_address=self.config["device"]["mac_addr"],
+                alias=self.config["device"]["alias"],
+                on_data=self.on_data_received,
+                on_connect_fail=self.__on_connect_fail,
+                notify_uuid=NOTIFY_CHAR_UUID,
+                write_uuid=WRITE_CHAR_UUID,
+                on_disconnect=self.__on_disconnected,
+                adapter=self.config["device"].get("adapter"),
+                backend=self.config.get("backend"),
+            )
+            if links is not None:
+                links[mac_address] = manager
+        manager.add_listener(
+            self.device_id, self.on_data_received, self.__on_disconnected
         )
+        return manager
+
+    async def connect(self):
+        self.bleManager = self.create_ble_manager()
 
         await self.bleManager.connect(lock=self.config["lock"])
         if not self.bleManager.device:
@@ -64,65 +146,320 @@ class BaseClient:
                 await self.read_section()
 
     async def disconnect(self):
-        await self.bleManager.disconnect()
+        # a shared hub link stays up until its last device lets go of it
+        if self.bleManager and self.bleManager.remove_listener(
+            self.device_id, self.on_data_received
+        ):
+            await self.bleManager.disconnect()
+
+    # Reads every section once over a long-lived session and returns the
+    # reading (or None if the device could not be reached / timed out).
+    async def poll(self):
+        if self.bleManager is None:
+            self.bleManager = self.create_ble_manager()
+        else:  # stop() unregisters the device from a (possibly shared) link
+            self.bleManager.add_listener(
+                self.device_id, self.on_data_received, self.__on_disconnected
+            )
+        if self.config["device"].get("bleak_device"):
+            self.bleManager.device = self.config["device"]["bleak_device"]
+        alias = self.config["device"]["alias"]
+        if not await self.bleManager.ensure_connected(self.config["lock"]):
+            POLLS.inc(device=alias, result="unreachable")
+            return None
+
+        async with self.bleManager.poll_lock:
+            self.poll_future = self.loop.create_future()
+            self.read_index = 0
+            self.read_attempt = 0
+            self.timeouts = 0
+            started = time.monotonic()
+            try:
+                await self.read_section()
+                result = await self.poll_future
+                POLLS.inc(device=alias, result="ok" if result else "failed")
+                return result
+            except asyncio.CancelledError:
+                # poll deadline hit, drop the in-flight read so the next poll starts clean
+                self.reset_read()
+                POLLS.inc(device=alias, result="deadline")
+                raise
+            finally:
+                self.poll_future = None
+                self.read_duration = time.monotonic() - started
+                POLL_SECONDS.observe(self.read_duration, device=alias)
+
+    # Polls every `interval` secs (default poll_interval) and yields the readings
+    # as records. Up to `buffer` readings are queued, after that polling waits
+    # for the consumer. A failed poll ends the stream with its exception, raised
+    # from the generator. Example: async for reading in client.stream(): ...
+    async def stream(self, interval=None, buffer=STREAM_BUFFER):
+        if interval is None:
+            interval = self.config["data"]["poll_interval"]
+        queue = asyncio.Queue(maxsize=buffer)
+        producer = self.create_task(self.__produce(queue, interval))
+        try:
+            while True:
+                reading = await queue.get()
+                if isinstance(reading, Exception):
+                    raise reading
+                yield reading
+        finally:
+            producer.cancel()
+
+    async def __produce(self, queue, interval):
+        try:
+            while True:
+                started = self.loop.time()
+                data = await self.poll()
+                if data:
+                    await queue.put(self.reading_class.from_dict(data))
+                await asyncio.sleep(max(0, interval - (self.loop.time() - started)))
+        except Exception as e:
+            await queue.put(e)  # handed to the consumer after the queued readings
+
+    # create_task that keeps a reference until the task is done and logs failures
+    def create_task(self, coroutine):
+        task = self.loop.create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.__on_task_done)
+        return task
+
+    def __on_task_done(self, task):
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception():
+            logging.error(f"Background task failed: {task.exception()!r}")
+
+    @property
+    def timings(self):
+        return {
+            "connects": self.bleManager.connect_count if self.bleManager else 0,
+            "connect_time": self.bleManager.connect_duration if self.bleManager else 0,
+            "read_time": self.read_duration,
+        }
+
+    def finish_poll(self, result=None):
+        if self.poll_future and not self.poll_future.done():
+            self.poll_future.set_result(result)
 
     async def on_data_received(self, response):
-        if self.read_timeout and not self.read_timeout.cancelled():
-            self.read_timeout.cancel()
         operation = bytes_to_int(response, 1, 1)
 
-        if operation == 3:  # read operation
+        if operation in (3, 0x83):  # read response or Modbus exception
             logging.debug(f"on_data_received: response for read operation")
-            if (
-                self.section_index < len(self.sections)
-                and self.sections[self.section_index]["parser"]
-                and self.sections[self.section_index]["words"] * 2 + 5 == len(response)
+            if self.persistent and self.poll_future is None:
+                return logging.debug("on_data_received: no poll in progress, dropped")
+            read = (
+                self.reads[self.read_index]
+                if self.read_index < len(self.reads)
+                else None
+            )
+            if read is None or (
+                operation == 3 and read["words"] * 2 + 5 != len(response)
             ):
+                # late answer to a request that already timed out, keep waiting
+                return logging.debug("on_data_received: unexpected response, dropped")
+            if self.read_timeout and not self.read_timeout.cancelled():
+                self.read_timeout.cancel()
+            self.timeouts = 0
+            rtt = self.pacer.on_response()
+            if rtt is not None:
+                RTT_SECONDS.observe(
+                    rtt,
+                    device=self.config["device"]["alias"],
+                    register=read["register"],
+                )
+
+            if operation == 3:
                 # parse and update data
-                self.sections[self.section_index]["parser"](response)
-
-            if (
-                self.section_index >= len(self.sections) - 1
-            ):  # last section, read complete
-                self.section_index = 0
-                self.on_read_operation_complete()
-                self.data = {}
-                await self.check_polling()
+                for section, frame in split_response(read, response):
+                    if section["parser"]:
+                        section["parser"](frame)
+                    if section.get("static") and self.cache:
+                        self.cache.put(self.cache_key(section), frame)
+                    else:
+                        self.schedule.update(section, frame)
+                self.set_quality(read, QUALITY_OK)
             else:
-                self.section_index += 1
-                await asyncio.sleep(0.5)
-                await self.read_section()
+                # retrying will not help, the device rejected the request
+                code = MODBUS_EXCEPTIONS.get(response[2], response[2])
+                logging.warning(
+                    f"{self.config['device']['alias']} register {read['register']}: exception {code}"
+                )
+                self.set_quality(read, QUALITY_EXCEPTION)
+            await self.next_read()
         else:
+            if self.read_timeout and not self.read_timeout.cancelled():
+                self.read_timeout.cancel()
+            self.pacer.on_response()
             logging.warn("on_data_received: unknown operation={}".format(operation))
 
+    async def next_read(self):
+        if self.read_index >= len(self.reads) - 1:  # last read, read complete
+            await self.complete_read()
+        else:
+            self.read_index += 1
+            self.read_attempt = 0
+            await self.pacer.wait()
+            await self.read_section()
+
+    def set_quality(self, read, quality):
+        for section, _ in read["sections"]:
+            self.quality[str(section["register"])] = quality
+
+    async def complete_read(self):
+        self.read_index = 0
+        self.reads = []
+        self.schedule.idle = self.is_idle()
+        self.data["__quality"] = self.quality
+        self.quality = {}
+        self.on_read_operation_complete()
+        self.data = {}
+        await self.check_polling()
+
     def on_read_operation_complete(self):
         logging.debug("on_read_operation_complete")
         self.data["__device"] = self.config["device"]["alias"]
         self.data["__client"] = self.__class__.__name__
         if self.on_data_callback:
-            asyncio.create_task(self.on_data_callback(self, self.data))
+            self.create_task(self.on_data_callback(self, self.data))
+        self.finish_poll(self.data)
 
+    # A lost response is retried with the pacer's backed off timeout. Once the
+    # retries are used up the poll goes on without those sections (they are
+    # flagged in __quality). After max_consecutive_timeouts reads in a row the
+    # device is most likely gone: the poll ends with the sections read so far
+    # (the rest flagged too), or is given up if no read got an answer at all.
     def on_read_timeout(self):
+        self.pacer.on_timeout()
+        READ_TIMEOUTS.inc(device=self.config["device"]["alias"])
+        read = (
+            self.reads[self.read_index] if self.read_index < len(self.reads) else None
+        )
+        retries = self.config["device"].get(
+            "read_retries", self.config["data"].get("read_retries", READ_RETRIES)
+        )
+        if read and self.read_attempt < retries:
+            self.read_attempt += 1
+            logging.warning(
+                f"{self.config['device']['alias']} register {read['register']} timed out, "
+                f"retry {self.read_attempt}/{retries}"
+            )
+            self.create_task(self.read_section())
+            return
+        if read:
+            self.set_quality(read, QUALITY_TIMEOUT)
+            self.timeouts += 1
+            answered = any(
+                quality in (QUALITY_OK, QUALITY_EXCEPTION)
+                for quality in self.quality.values()
+            )
+            last = self.read_index >= len(self.reads) - 1
+            limit = self.config["device"].get(
+                "max_consecutive_timeouts",
+                self.config["data"].get(
+                    "max_consecutive_timeouts", MAX_CONSECUTIVE_TIMEOUTS
+                ),
+            )
+            if answered and self.timeouts >= limit:
+                logging.warning(
+                    f"{self.config['device']['alias']} {self.timeouts} reads timed out "
+                    "in a row, finishing with a partial reading"
+                )
+                for remaining in self.reads[self.read_index + 1 :]:
+                    self.set_quality(remaining, QUALITY_TIMEOUT)
+                self.create_task(self.complete_read())
+                return
+            if answered or (self.timeouts < limit and not last):
+                logging.warning(
+                    f"{self.config['device']['alias']} register {read['register']} failed, "
+                    "continuing with a partial reading"
+                )
+                self.create_task(self.next_read())
+                return
         logging.error("on_read_timeout => Timed out! Please check your device_id!")
-        asyncio.create_task(self.stop())
+        if self.persistent:
+            # keep the session, the next poll starts over from the first section
+            self.reset_read()
+            self.finish_poll()
+        else:
+            self.create_task(self.stop())
 
     async def check_polling(self):
-        if bool(self.config["data"]["enable_polling"]):
+        if bool(self.config["data"]["enable_polling"]) and not self.persistent:
             await asyncio.sleep(self.config["data"]["poll_interval"])
             await self.read_section()
 
+    def cache_key(self, section):
+        return self.cache.key(
+            self.config["device"]["mac_addr"], self.device_id, section["register"]
+        )
+
+    # Feeds cached static sections to their parsers, returns True on a cache hit
+    def replay_cached(self, section):
+        if not section.get("static") or not self.cache:
+            return False
+        frame = self.cache.get(self.cache_key(section))
+        if frame is None:
+            return False
+        section["parser"](frame)
+        self.quality[str(section["register"])] = QUALITY_CACHED
+        CACHE_HITS.inc(device=self.config["device"]["alias"])
+        return True
+
+    # Feeds the last response of a section that is not due to its parser
+    def replay_scheduled(self, section):
+        if self.schedule.due(section):
+            return False
+        section["parser"](self.schedule.frame(section))
+        self.quality[str(section["register"])] = QUALITY_HELD
+        return True
+
+    # True while the device has nothing going on (e.g. no PV), stretches intervals
+    def is_idle(self):
+        return False
+
+    # Whether any section needs a read, polls can be skipped altogether otherwise
+    def is_due(self):
+        return any(
+            self.schedule.due(section)
+            for section in self.sections
+            if not (section.get("static") and self.cache)
+        )
+
+    def plan_reads(self):
+        return plan_reads(
+            [
+                section
+                for section in self.sections
+                if not self.replay_cached(section)
+                and not self.replay_scheduled(section)
+            ],
+            max_words=self.config["device"].get(
+                "max_read_words", DEFAULT_MAX_READ_WORDS
+            ),
+            max_gap=self.config["device"].get("max_gap_words", self.max_gap_words),
+        )
+
     async def read_section(self):
-        index = self.section_index
         if self.device_id is None or not self.sections:
             return logging.error("BaseClient cannot be used directly")
+        if not self.reads:
+            self.reads = self.plan_reads()
+            logging.debug(
+                f"{len(self.sections)} sections planned as {len(self.reads)} reads"
+            )
+            if not self.reads:  # everything was served from the cache
+                return await self.complete_read()
 
-        self.read_timeout = self.loop.call_later(READ_TIMEOUT, self.on_read_timeout)
+        read = self.reads[self.read_index]
         request = self.create_generic_read_request(
-            self.device_id,
-            3,
-            self.sections[index]["register"],
-            self.sections[index]["words"],
+            self.device_id, 3, read["register"], read["words"]
         )
+        self.read_timeout = self.loop.call_later(
+            self.pacer.timeout, self.on_read_timeout
+        )
+        self.pacer.on_request()
         await self.bleManager.characteristic_write_value(request)
 
     def create_generic_read_request(self, device_id, function, regAddr, readWrd):
@@ -144,13 +481,29 @@ class BaseClient:
 
     def __on_error(self, error=None):
         logging.error(f"Exception occurred: {error}")
-        asyncio.create_task(self.stop())
+        self.create_task(self.stop())
 
     def __on_connect_fail(self, error):
         logging.error(f"Connection failed: {error}")
-        asyncio.create_task(self.stop())
+        if not self.persistent:
+            self.create_task(self.stop())
+
+    def __on_disconnected(self):
+        self.reset_read()
+        self.finish_poll()
+
+    def reset_read(self):
+        if self.read_timeout and not self.read_timeout.cancelled():
+            self.read_timeout.cancel()
+        self.read_index = 0
+        self.read_attempt = 0
+        self.timeouts = 0
+        self.reads = []
+        self.quality = {}
+        self.data = {}
 
     async def stop(self):
         if self.read_timeout and not self.read_timeout.cancelled():
             self.read_timeout.cancel()
+        self.finish_poll()
         await self.disconnect()
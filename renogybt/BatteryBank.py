@@ -0,0 +1,234 @@
+import math
+import operator
+import time
+from array import array
+from collections import deque
+
+# Bank level view of daisy-chained batteries (hub ids 48, 49, 50...). The cell
+# voltages and temperatures of every battery of a bank are kept in two
+# contiguous arrays, battery after battery; a new reading overwrites its slice in
+# place. Statistics run over the whole bank in single passes of builtin
+# reductions (min/max/sum/map) on those arrays: min, max, mean, delta, imbalance
+# and outlier cells (further from the mean than `outlier_sigma` deviations and at
+# least `outlier_volts`). Trend slopes (per hour) of the mean voltage, the delta
+# and the hottest sensor are least-squares fits over the last `trend_window`
+# samples, updated with running sums. One compact 'bank' reading per bank, e.g.
+# {'__device': 'battery-bank', 'cells': 16, 'cell_voltage_delta': 0.02,
+#  'imbalance_pct': 0.6, 'outlier_cells': '49:3', 'cell_voltage_mean_slope': -0.01}
+
+DEFAULT_BANK = "battery-bank"
+BANK_MODEL = "renogy-bt-bank"
+DEFAULT_TREND_WINDOW = 30  # samples per slope
+DEFAULT_OUTLIER_SIGMA = 2
+DEFAULT_OUTLIER_VOLTS = 0.03  # smaller deviations are never outliers
+DEFAULT_STALE_AFTER = 3600  # batteries not heard from are left out (seconds)
+
+
+# cell values of a battery reading, as lists or as cell_voltage_0, 1... keys
+def cell_values(data, key, prefix):
+    values = data.get(key)
+    if values is not None:
+        return values
+    values = []
+    while f"{prefix}_{len(values)}" in data:
+        values.append(data[f"{prefix}_{len(values)}"])
+    return values
+
+
+# min, max, mean and standard deviation of an array
+def summary(values):
+    count = len(values)
+    mean = sum(values) / count
+    variance = sum(map(operator.mul, values, values)) / count - mean * mean
+    return min(values), max(values), mean, math.sqrt(max(0, variance))
+
+
+# Least-squares slope over a sliding window, O(1) per sample
+class Trend:
+    def __init__(self, window=DEFAULT_TREND_WINDOW):
+        self.samples = deque()
+        self.window = window
+        self.origin = None  # keeps the time sums small
+        self.sums = [0, 0, 0, 0]  # t, y, t*t, t*y
+
+    def add(self, timestamp, value):
+        if self.origin is None:
+            self.origin = timestamp
+        t = timestamp - self.origin
+        self.samples.append((t, value))
+        self.__accumulate(t, value, 1)
+        if len(self.samples) > self.window:
+            self.__accumulate(*self.samples.popleft(), -1)
+
+    def __accumulate(self, t, value, sign):
+        sums = self.sums
+        sums[0] += sign * t
+        sums[1] += sign * value
+        sums[2] += sign * t * t
+        sums[3] += sign * t * value
+
+    # change per hour, None until two samples apart in time
+    def slope(self):
+        n = len(self.samples)
+        st, sy, stt, sty = self.sums
+        denominator = n * stt - st * st
+        if n < 2 or denominator <= 0:
+            return None
+        return (n * sty - st * sy) / denominator * 3600
+
+
+class BatteryBank:
+    def __init__(
+        self,
+        name,
+        trend_window=DEFAULT_TREND_WINDOW,
+        outlier_sigma=DEFAULT_OUTLIER_SIGMA,
+        outlier_volts=DEFAULT_OUTLIER_VOLTS,
+    ):
+        self.name = name
+        self.outlier_sigma = outlier_sigma
+        self.outlier_volts = outlier_volts
+        self.batteries = {}  # alias => {'id', 'seen', 'cells', 'sensors'}
+        self.voltages = array("d")  # every cell of the bank
+        self.temperatures = array("d")
+        self.slices = {}  # alias => (voltage offset, temperature offset)
+        self.labels = []  # 'device_id:cell' of every entry of self.voltages
+        self.trends = {
+            "cell_voltage_mean": Trend(trend_window),
+            "cell_voltage_delta": Trend(trend_window),
+            "temperature_max": Trend(trend_window),
+        }
+
+    def update(self, alias, device_id, voltages, temperatures, now):
+        battery = self.batteries.get(alias)
+        if (
+            battery
+            and battery["cells"] == len(voltages)
+            and battery["sensors"] == len(temperatures)
+        ):
+            battery["seen"] = now
+            voltage_offset, temperature_offset = self.slices[alias]
+            end = voltage_offset + len(voltages)
+            self.voltages[voltage_offset:end] = array("d", voltages)
+            end = temperature_offset + len(temperatures)
+            self.temperatures[temperature_offset:end] = array("d", temperatures)
+            return
+        self.batteries[alias] = {
+            "id": device_id,
+            "seen": now,
+            "cells": len(voltages),
+            "sensors": len(temperatures),
+        }
+        self.rebuild({alias: (voltages, temperatures)})
+
+    # Lays the batteries out again (by device id) after one came, went or changed
+    def rebuild(self, new=None):
+        new = new or {}
+        voltages, temperatures = array("d"), array("d")
+        slices, labels = {}, []
+        for alias, battery in sorted(
+            self.batteries.items(), key=lambda item: (item[1]["id"], item[0])
+        ):
+            if alias in new:
+                cells, sensors = new[alias]
+            else:
+                voltage_offset, temperature_offset = self.slices[alias]
+                cells = self.voltages[
+                    voltage_offset : voltage_offset + battery["cells"]
+                ]
+                sensors = self.temperatures[
+                    temperature_offset : temperature_offset + battery["sensors"]
+                ]
+            slices[alias] = (len(voltages), len(temperatures))
+            labels += [f"{battery['id']}:{i}" for i in range(battery["cells"])]
+            voltages.extend(cells)
+            temperatures.extend(sensors)
+        self.voltages, self.temperatures = voltages, temperatures
+        self.slices, self.labels = slices, labels
+
+    def expire(self, before):
+        stale = [a for a, b in self.batteries.items() if b["seen"] < before]
+        for alias in stale:
+            del self.batteries[alias]
+        if stale:
+            self.rebuild()
+
+    def reading(self, now):
+        if not self.voltages:
+            return None
+        low, high, mean, deviation = summary(self.voltages)
+        limit = max(self.outlier_sigma * deviation, self.outlier_volts)
+        outliers = [
+            self.labels[i]
+            for i, voltage in enumerate(self.voltages)
+            if abs(voltage - mean) > limit
+        ]
+        reading = {
+            "function": "BANK",
+            "model": BANK_MODEL,
+            "batteries": len(self.batteries),
+            "cells": len(self.voltages),
+            "cell_voltage_min": round(low, 3),
+            "cell_voltage_max": round(high, 3),
+            "cell_voltage_mean": round(mean, 3),
+            "cell_voltage_delta": round(high - low, 3),
+            "imbalance_pct": round((high - low) / mean * 100, 2) if mean else 0,
+            "outlier_count": len(outliers),
+            "outlier_cells": ",".join(outliers),
+        }
+        if self.temperatures:
+            low_t, high_t, mean_t, _ = summary(self.temperatures)
+            reading["temperature_min"] = round(low_t, 1)
+            reading["temperature_max"] = round(high_t, 1)
+            reading["temperature_mean"] = round(mean_t, 1)
+        for field, trend in self.trends.items():
+            if field in reading:
+                trend.add(now, reading[field])
+                slope = trend.slope()
+                if slope is not None:
+                    reading[f"{field}_slope"] = round(slope, 4)
+        reading["__device"] = self.name
+        return reading
+
+
+# Groups battery readings into banks (device 'bank', default one bank)
+class BankAggregator:
+    def __init__(
+        self,
+        trend_window=DEFAULT_TREND_WINDOW,
+        outlier_sigma=DEFAULT_OUTLIER_SIGMA,
+        outlier_volts=DEFAULT_OUTLIER_VOLTS,
+        stale_after=DEFAULT_STALE_AFTER,
+    ):
+        self.trend_window = trend_window
+        self.outlier_sigma = outlier_sigma
+        self.outlier_volts = outlier_volts
+        self.stale_after = stale_after
+        self.banks = {}
+
+    def update(self, data, bank=DEFAULT_BANK, timestamp=None):
+        voltages = cell_values(data, "cell_voltages", "cell_voltage")
+        if not voltages or data.get("__device") is None:
+            return
+        if bank not in self.banks:
+            self.banks[bank] = BatteryBank(
+                bank, self.trend_window, self.outlier_sigma, self.outlier_volts
+            )
+        self.banks[bank].update(
+            data["__device"],
+            data.get("device_id", 0),
+            voltages,
+            cell_values(data, "temperatures", "temperature"),
+            time.time() if timestamp is None else timestamp,
+        )
+
+    # One reading per bank, also advances the trends (call once per cycle)
+    def readings(self, timestamp=None):
+        now = time.time() if timestamp is None else timestamp
+        readings = []
+        for bank in self.banks.values():
+            bank.expire(now - self.stale_after)
+            reading = bank.reading(now)
+            if reading:
+                readings.append(reading)
+        return readings
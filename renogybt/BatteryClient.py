@@ -1,12 +1,40 @@
 from .BaseClient import BaseClient
+from .Readings import make_reading
+from .RegisterDecoder import ArrayDecoder, Field, RegisterDecoder
 from .Utils import bytes_to_int, format_temperature
 
 # Client for Renogy LFP battery with built-in bluetooth / BT-2 module
+# With 'cell_arrays' (device or data section) cells are reported as the lists
+# 'cell_voltages' / 'temperatures' instead of cell_voltage_0, temperature_0...
 
 FUNCTION = {3: "READ", 6: "WRITE"}
 
+# cell count / sensor count register followed by up to 16 values
+CELL_VOLTAGES = ArrayDecoder(5, 16, scale=0.1)
+CELL_TEMPERATURES = ArrayDecoder(5, 16, signed=True, scale=0.1)
+
+BATTERY_INFO = RegisterDecoder(
+    [
+        Field("function", 1, 1, enum=FUNCTION),
+        Field("current", 3, 2, True, scale=0.01),
+        Field("voltage", 5, 2, scale=0.1),
+        Field("remaining_charge", 7, 4, scale=0.001),
+        Field("capacity", 11, 4, scale=0.001),
+    ]
+)
+
+
+BatteryReading = make_reading(
+    "BatteryReading",
+    [BATTERY_INFO],
+    {"cell_count": int, "sensor_count": int, "model": str, "device_id": int},
+    arrays={"cell_voltages": "cell_voltage", "temperatures": "temperature"},
+)
+
 
 class BatteryClient(BaseClient):
+    reading_class = BatteryReading
+
     def __init__(self, config, on_data_callback=None):
         super().__init__(config)
         self.on_data_callback = on_data_callback
@@ -15,37 +43,55 @@ class BatteryClient(BaseClient):
             {"register": 5000, "words": 17, "parser": self.parse_cell_volt_info},
             {"register": 5017, "words": 17, "parser": self.parse_cell_temp_info},
             {"register": 5042, "words": 6, "parser": self.parse_battery_info},
-            {"register": 5122, "words": 8, "parser": self.parse_device_info},
-            {"register": 5223, "words": 1, "parser": self.parse_device_address},
+            {
+                "register": 5122,
+                "words": 8,
+                "parser": self.parse_device_info,
+                "static": True,
+            },
+            {
+                "register": 5223,
+                "words": 1,
+                "parser": self.parse_device_address,
+                "static": True,
+            },
         ]
+        self.cell_arrays = bool(
+            self.config["device"].get(
+                "cell_arrays", self.config["data"].get("cell_arrays", False)
+            )
+        )
 
     def parse_cell_volt_info(self, bs):
         data = {}
         data["function"] = FUNCTION.get(bytes_to_int(bs, 1, 1))
         data["cell_count"] = bytes_to_int(bs, 3, 2)
-        for i in range(0, data["cell_count"]):
-            data[f"cell_voltage_{i}"] = bytes_to_int(bs, 5 + i * 2, 2, scale=0.1)
+        voltages = CELL_VOLTAGES.decode(bs, data["cell_count"])
+        if self.cell_arrays:
+            data["cell_voltages"] = voltages
+        else:
+            for i, voltage in enumerate(voltages):
+                data[f"cell_voltage_{i}"] = voltage
         self.data.update(data)
 
     def parse_cell_temp_info(self, bs):
         data = {}
         data["function"] = FUNCTION.get(bytes_to_int(bs, 1, 1))
         data["sensor_count"] = bytes_to_int(bs, 3, 2)
-        for i in range(0, data["sensor_count"]):
-            celcius = bytes_to_int(bs, 5 + i * 2, 2, scale=0.1, signed=True)
-            data[f"temperature_{i}"] = format_temperature(
-                celcius, self.config["data"]["temperature_unit"]
-            )
+        unit = self.config["data"]["temperature_unit"]
+        temperatures = [
+            format_temperature(celcius, unit)
+            for celcius in CELL_TEMPERATURES.decode(bs, data["sensor_count"])
+        ]
+        if self.cell_arrays:
+            data["temperatures"] = temperatures
+        else:
+            for i, temperature in enumerate(temperatures):
+                data[f"temperature_{i}"] = temperature
         self.data.update(data)
 
     def parse_battery_info(self, bs):
-        data = {}
-        data["function"] = FUNCTION.get(bytes_to_int(bs, 1, 1))
-        data["current"] = bytes_to_int(bs, 3, 2, True, scale=0.01)
-        data["voltage"] = bytes_to_int(bs, 5, 2, scale=0.1)
-        data["remaining_charge"] = bytes_to_int(bs, 7, 4, scale=0.001)
-        data["capacity"] = bytes_to_int(bs, 11, 4, scale=0.001)
-        self.data.update(data)
+        self.data.update(BATTERY_INFO.decode(bs))
 
     def parse_device_info(self, bs):
         data = {}
@@ -1,147 +1,530 @@
+import asyncio
+import functools
+import hashlib
 import json
 import logging
+import os
+import random
+import time
 import aiohttp
 import string
-from datetime import datetime
+from .DeltaFilter import DEFAULT_REFRESH_INTERVAL, DeltaFilter
+from .Metrics import (
+    QUEUE_DEPTH,
+    REGISTRY,
+    SINK_EVENTS,
+    SINK_SECONDS,
+    SPOOL_BACKLOG,
+    SPOOL_BYTES,
+    SPOOL_DRAIN_RATE,
+)
+from .PVOutput import (
+    BATCH_STATUS_PATH,
+    PVOUTPUT_BASE_URL,
+    STATUS_INTERVAL,
+    PVOutputBatcher,
+)
+from .Spool import (
+    DEFAULT_FSYNC_INTERVAL,
+    DEFAULT_MAX_AGE,
+    DEFAULT_MAX_BYTES,
+    DEFAULT_SEGMENT_BYTES,
+    Spool,
+)
 
-PVOUTPUT_URL = "http://pvoutput.org/service/r2/addstatus.jsp"
+DISCOVERY_REGISTRY_FILE = "discovery_registry.json"
+DISCOVERY_SKIP_FIELDS = {
+    "function",
+    "model",
+    "device_id",
+    "__device",
+    "__client",
+    "__quality",
+    "period",
+    "period_start",
+    "cell_voltages",
+    "temperatures",
+}
+PVOUTPUT_MIN_INTERVAL = 60  # free accounts may send one request per minute (seconds)
+SINK_SECTIONS = {"remote": "remote_logging", "mqtt": "mqtt", "pvoutput": "pvoutput"}
+
+# Readings are handed to the sinks through one bounded queue per sink, so the BLE
+# path only enqueues and a slow endpoint never holds up a poll. Each sink has a
+# worker that retries failed deliveries with jittered exponential backoff.
+SINK_QUEUE_SIZE = 100  # readings buffered per sink
+SINK_RETRIES = 3  # extra attempts after a failed delivery
+SINK_BACKOFF = 2  # first retry delay, doubled every attempt (seconds)
+SINK_MAX_BACKOFF = 60  # (seconds)
+SINK_OVERFLOW = "drop_oldest"  # or "drop_newest" when a sink queue is full
+HTTP_TIMEOUT = 15  # (seconds)
+
+# With "spool": {"enabled": true} readings a sink still fails to deliver after
+# its retries go to a per sink journal on disk (see Spool) instead of being lost.
+# A replay task sends them back in order, `batch` at a time and at most
+# `catch_up_rate` readings per sec, once the sink accepts deliveries again.
+# While a backlog exists new readings queue up behind it, so order is kept.
+SPOOL_BATCH = 50
+SPOOL_CATCH_UP_RATE = 10  # (readings per second)
+
+
+# Home Assistant sensor settings derived from the field name, computed once per field
+@functools.lru_cache(maxsize=None)
+def entity_class(entity):
+    config = {}
+    if "current" in entity:
+        config["device_class"] = "current"
+        config["unit_of_measurement"] = "A"
+        config["state_class"] = "measurement"
+    elif "percent" in entity:
+        config["device_class"] = "battery"
+        config["unit_of_measurement"] = "%"
+        config["state_class"] = "measurement"
+    elif "voltage" in entity:
+        config["device_class"] = "voltage"
+        config["unit_of_measurement"] = "V"
+        config["state_class"] = "measurement"
+    elif "amp_hour" in entity:
+        config["unit_of_measurement"] = "ah"
+        config["state_class"] = "total_increasing"
+    elif "temperature" in entity:
+        config["device_class"] = "temperature"
+        config["unit_of_measurement"] = "°F"
+        config["state_class"] = "measurement"
+    elif "charging_power" in entity:
+        config["device_class"] = "power"
+        config["unit_of_measurement"] = "W"
+        config["state_class"] = "total_increasing"
+    elif "power" in entity and "today" in entity:
+        config["device_class"] = "energy"
+        config["unit_of_measurement"] = "Wh"
+        config["state_class"] = "total_increasing"
+    elif "power" in entity and "total" in entity:
+        config["device_class"] = "energy"
+        config["unit_of_measurement"] = "Wh"
+        config["state_class"] = "total"
+    elif "pv_power" in entity:
+        config["device_class"] = "energy"
+        config["unit_of_measurement"] = "W"
+        config["state_class"] = "measurement"
+    elif entity.endswith("_wh"):
+        # EnergyIntegrator buckets start over every period and carry no
+        # last_reset (per-field topics only hold the value), so they are plain
+        # measurements; Home Assistant rejects the energy class for those
+        config["unit_of_measurement"] = "Wh"
+        config["state_class"] = "measurement"
+    return config
+
+
+def content_hash(payload):
+    return hashlib.sha1(payload.encode()).hexdigest()
 
 
 class DataLogger:
     def __init__(self, config):
         self.config = config
         self.published_devices = set()
+        # discovery topic => hash of the payload last published, kept across restarts
+        self.discovery_registry = self.load_discovery_registry()
+        self.discovery_cache = {}
+        self.mqtt_client = None
+        self.session = None
+        self.queues = {}
+        self.workers = []
+        self.spools = {}  # sink => Spool, when spooling is enabled
+        self.sinks = {
+            "remote": self.log_remote,
+            "mqtt": self.log_mqtt,
+            "pvoutput": self.log_pvoutput,
+        }
+        pvoutput = self.config.get("pvoutput", {})
+        self.pvoutput = PVOutputBatcher(
+            status_interval=pvoutput.get("status_interval", STATUS_INTERVAL)
+        )
+        self.pvoutput_last_post = None
+        mqtt = self.config.get("mqtt", {})
+        # "delta" only publishes fields that changed beyond their deadband
+        self.mqtt_delta = mqtt.get("publish_mode", "full") == "delta"
+        self.mqtt_field_topics = bool(mqtt.get("field_topics", False))
+        self.delta_filter = DeltaFilter(
+            deadbands=mqtt.get("deadbands"),
+            default_abs=mqtt.get("deadband_abs", 0),
+            default_rel=mqtt.get("deadband_rel", 0),
+            refresh_interval=mqtt.get(
+                "full_refresh_interval", DEFAULT_REFRESH_INTERVAL
+            ),
+        )
+        self.stats = {
+            name: {
+                "delivered": 0,
+                "failed": 0,
+                "retries": 0,
+                "dropped": 0,
+                "spooled": 0,
+                "replayed": 0,
+                "expired": 0,
+            }
+            for name in self.sinks
+        }
 
     def set_mqtt_client(self, mqtt_client):
         self.mqtt_client = mqtt_client
 
-    async def log_remote(self, json_data):
-        headers = {
-            "Authorization": f"Bearer {self.config['remote_logging']['auth_header']}"
-        }
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                self.config["remote_logging"]["url"],
-                json=json_data,
-                timeout=15,
-                headers=headers,
-            ) as req:
-                if req.status == 200:
-                    logging.info("Log remote 200")
-                else:
-                    logging.error(f"Log remote error {req.status}")
-
-    async def create_mqtt_device(self, device_data, device_name, device_model, topic):
-        logging.info(
-            f"Publishing MQTT device to Home Assistant discovery: {device_name}"
+    # Opens the pooled HTTP session and starts one worker per enabled sink
+    async def start(self):
+        self.session = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT),
+            connector=aiohttp.TCPConnector(limit_per_host=2, keepalive_timeout=300),
         )
+        queue_size = self.config["data"].get("sink_queue_size", SINK_QUEUE_SIZE)
+        spool = self.config.get("spool", {})
+        for name in self.sinks:
+            if self.config[SINK_SECTIONS[name]]["enabled"]:
+                self.queues[name] = asyncio.Queue(maxsize=queue_size)
+                self.workers.append(asyncio.create_task(self.__worker(name)))
+                # pvoutput keeps undelivered intervals itself
+                if spool.get("enabled") and name != "pvoutput":
+                    self.spools[name] = Spool(
+                        os.path.join(spool.get("path", "spool"), name),
+                        max_bytes=spool.get("max_bytes", DEFAULT_MAX_BYTES),
+                        max_age=spool.get("max_age", DEFAULT_MAX_AGE),
+                        segment_bytes=spool.get("segment_bytes", DEFAULT_SEGMENT_BYTES),
+                        fsync_interval=spool.get(
+                            "fsync_interval", DEFAULT_FSYNC_INTERVAL
+                        ),
+                    )
+                    self.workers.append(asyncio.create_task(self.__replayer(name)))
+        REGISTRY.add_collector(self.collect_metrics)
 
-        # Clean up fields before publishing
-        remove_fields = ["function", "model", "device_id", "__device", "__client"]
-        for field in remove_fields:
-            device_data.pop(field)
+    async def close(self):
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+        for spool in self.spools.values():
+            spool.close()
+        self.spools = {}
+        if self.collect_metrics in REGISTRY.collectors:
+            REGISTRY.collectors.remove(self.collect_metrics)
+        if self.session:
+            await self.session.close()
+            self.session = None
 
-        for entity in device_data:
-            discovery_topic = f"homeassistant/sensor/{device_name}_{entity}/config"
+    # Non-blocking hand off of a reading to a sink worker
+    def enqueue(self, sink, json_data):
+        queue = self.queues.get(sink)
+        if queue is None:
+            return logging.warning(f"Sink {sink} is not enabled")
+        if queue.full():
+            self.count(sink, "dropped")
+            if self.config["data"].get("sink_overflow", SINK_OVERFLOW) == "drop_newest":
+                return logging.warning(f"{sink} queue full, dropping newest reading")
+            queue.get_nowait()
+            logging.warning(f"{sink} queue full, dropping oldest reading")
+        # each sink gets its own copy, sinks must not see each other's changes
+        queue.put_nowait(dict(json_data))
 
-            name = string.capwords(entity.replace("_", " ")).replace("Pv", "PV")
+    async def __worker(self, sink):
+        queue = self.queues[sink]
+        retries = self.config["data"].get("sink_retries", SINK_RETRIES)
+        spool = self.spools.get(sink)
+        while True:
+            json_data = await queue.get()
+            if spool and spool.backlog:  # queue up behind the spooled readings
+                self.spool_reading(sink, json_data)
+                queue.task_done()
+                continue
+            for attempt in range(retries + 1):
+                if await self.deliver(sink, json_data):
+                    self.count(sink, "delivered")
+                    break
+                if attempt < retries:
+                    self.count(sink, "retries")
+                    await asyncio.sleep(self.backoff(attempt))
+            else:
+                self.count(sink, "failed")
+                if spool:
+                    self.spool_reading(sink, json_data)
+            queue.task_done()
 
+    # One delivery attempt, True if the sink accepted the reading
+    async def deliver(self, sink, json_data):
+        started = time.monotonic()
+        try:
+            delivered = await self.sinks[sink](json_data=json_data) is not False
+        except Exception as e:
+            logging.error(f"{sink} delivery failed: {e}")
+            delivered = False
+        SINK_SECONDS.observe(time.monotonic() - started, sink=sink)
+        return delivered
+
+    @staticmethod
+    def backoff(attempt):
+        delay = min(SINK_BACKOFF * 2**attempt, SINK_MAX_BACKOFF)
+        return delay * random.uniform(0.5, 1.5)
+
+    def spool_reading(self, sink, json_data):
+        spool = self.spools[sink]
+        expired = spool.expired
+        try:
+            spool.append(json_data)
+            self.count(sink, "spooled")
+            for _ in range(spool.expired - expired):  # pushed out by the bounds
+                self.count(sink, "expired")
+        except Exception as e:
+            self.count(sink, "dropped")
+            logging.error(f"Could not spool {sink} reading: {e}")
+
+    # Replays the spooled readings of a sink in order, at the catch-up rate
+    async def __replayer(self, sink):
+        spool = self.spools[sink]
+        config = self.config.get("spool", {})
+        batch = config.get("batch", SPOOL_BATCH)
+        rate = config.get("catch_up_rate", SPOOL_CATCH_UP_RATE)
+        failures = 0
+        while True:
+            if not spool.backlog:
+                spool.ready.clear()
+                await spool.ready.wait()
+            entries = spool.read(batch)
+            if not entries:
+                spool.backlog = 0
+                continue
+            started = time.monotonic()
+            replayed = 0
+            for json_data, _ in entries:
+                if not await self.deliver(sink, json_data):
+                    break
+                replayed += 1
+                self.count(sink, "replayed")
+            if replayed:
+                spool.commit(entries[replayed - 1][1], replayed)
+            if replayed < len(entries):
+                logging.warning(
+                    f"{sink} still failing, {spool.backlog} readings spooled"
+                )
+                await asyncio.sleep(self.backoff(failures))
+                failures += 1
+                continue
+            failures = 0
+            await asyncio.sleep(max(0, replayed / rate - (time.monotonic() - started)))
+            elapsed = time.monotonic() - started
+            SPOOL_DRAIN_RATE.set(round(replayed / max(elapsed, 1e-6), 2), sink=sink)
+
+    def count(self, sink, event):
+        self.stats[sink][event] += 1
+        SINK_EVENTS.inc(sink=sink, event=event)
+
+    def collect_metrics(self):
+        for sink, queue in self.queues.items():
+            QUEUE_DEPTH.set(queue.qsize(), sink=sink)
+        for sink, spool in self.spools.items():
+            SPOOL_BACKLOG.set(spool.backlog, sink=sink)
+            SPOOL_BYTES.set(spool.backlog_bytes(), sink=sink)
+
+    async def log_remote(self, json_data):
+        headers = {
+            "Authorization": f"Bearer {self.config['remote_logging']['auth_header']}"
+        }
+        async with self.session.post(
+            self.config["remote_logging"]["url"],
+            json=json_data,
+            headers=headers,
+        ) as req:
+            if req.status == 200:
+                logging.info("Log remote 200")
+                return True
+            logging.error(f"Log remote error {req.status}")
+            return False
+
+    # Discovery payloads of one (device, model, field set), built once from the
+    # per-field entity templates. Returns {discovery topic: json payload}.
+    def discovery_payloads(self, device_name, device_model, topic, entities):
+        key = (device_name, device_model, topic, entities)
+        if key in self.discovery_cache:
+            return self.discovery_cache[key]
+        payloads = {}
+        device = {
+            "identifiers": [device_name],
+            "name": device_name,
+            "model": device_model,
+            "manufacturer": "Renogy",
+        }
+        for entity in entities:
             payload = {
-                "name": name,
-                "state_topic": topic,
-                "value_template": f"{{{{ value_json.{entity}}}}}",
+                "name": string.capwords(entity.replace("_", " ")).replace("Pv", "PV"),
+                "state_topic": f"{topic}/{entity}" if self.mqtt_field_topics else topic,
+                "value_template": (
+                    "{{ value }}"
+                    if self.mqtt_field_topics
+                    else f"{{{{ value_json.{entity}}}}}"
+                ),
                 "unique_id": f"{device_name}_{entity}",
-                "device": {
-                    "identifiers": [device_name],
-                    "name": device_name,
-                    "model": device_model,
-                    "manufacturer": "Renogy",
-                },
+                "device": device,
+                **entity_class(entity),
             }
+            discovery_topic = f"homeassistant/sensor/{device_name}_{entity}/config"
+            payloads[discovery_topic] = json.dumps(payload)
+        self.discovery_cache[key] = payloads
+        return payloads
 
-            # Entity specific configuration
-            if "current" in entity:
-                payload["device_class"] = "current"
-                payload["unit_of_measurement"] = "A"
-                payload["state_class"] = "measurement"
-            elif "percent" in entity:
-                payload["device_class"] = "battery"
-                payload["unit_of_measurement"] = "%"
-                payload["state_class"] = "measurement"
-            elif "voltage" in entity:
-                payload["device_class"] = "voltage"
-                payload["unit_of_measurement"] = "V"
-                payload["state_class"] = "measurement"
-            elif "amp_hour" in entity:
-                payload["unit_of_measurement"] = "ah"
-                payload["state_class"] = "total_increasing"
-            elif "temperature" in entity:
-                payload["device_class"] = "temperature"
-                payload["unit_of_measurement"] = "°F"
-                payload["state_class"] = "measurement"
-            elif "charging_power" in entity:
-                payload["device_class"] = "power"
-                payload["unit_of_measurement"] = "W"
-                payload["state_class"] = "total_increasing"
-            elif "power" in entity and "today" in entity:
-                payload["device_class"] = "energy"
-                payload["unit_of_measurement"] = "Wh"
-                payload["state_class"] = "total_increasing"
-            elif "power" in entity and "total" in entity:
-                payload["device_class"] = "energy"
-                payload["unit_of_measurement"] = "Wh"
-                payload["state_class"] = "total"
-            elif "pv_power" in entity:
-                payload["device_class"] = "energy"
-                payload["unit_of_measurement"] = "W"
-                payload["state_class"] = "measurement"
+    async def create_mqtt_device(self, device_data, device_name, device_model, topic):
+        entities = tuple(
+            field for field in device_data if field not in DISCOVERY_SKIP_FIELDS
+        )
+        payloads = self.discovery_payloads(device_name, device_model, topic, entities)
 
+        # Only entities whose config changed since the last run are republished
+        changed = {
+            discovery_topic: payload
+            for discovery_topic, payload in payloads.items()
+            if self.discovery_registry.get(discovery_topic) != content_hash(payload)
+        }
+        logging.info(
+            f"Home Assistant discovery for {device_name}: {len(changed)} of {len(payloads)} entities changed"
+        )
+        failed = False
+        for discovery_topic, payload in changed.items():
             try:
                 await self.mqtt_client.publish(
                     discovery_topic,
-                    payload=json.dumps(payload),
+                    payload=payload,
                     qos=0,
                     retain=True,
                 )
+                self.discovery_registry[discovery_topic] = content_hash(payload)
             except Exception as e:
                 logging.error(f"MQTT connection error: {e}")
+                failed = True
+        if changed:
+            self.save_discovery_registry()
 
-        # Add device to published list
-        self.published_devices.add(device_name)
+        # Add device to published list, a failed discovery is retried next time
+        if not failed:
+            self.published_devices.add((device_name, device_model, entities))
+
+    def load_discovery_registry(self):
+        path = self.config.get("mqtt", {}).get(
+            "discovery_registry", DISCOVERY_REGISTRY_FILE
+        )
+        if not path or not os.path.isfile(path):
+            return {}
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except Exception as e:
+            logging.warning(f"Ignoring unreadable discovery registry {path}: {e}")
+            return {}
+
+    def save_discovery_registry(self):
+        path = self.config.get("mqtt", {}).get(
+            "discovery_registry", DISCOVERY_REGISTRY_FILE
+        )
+        if not path:
+            return
+        try:
+            with open(f"{path}.tmp", "w") as f:
+                json.dump(self.discovery_registry, f)
+            os.replace(f"{path}.tmp", path)
+        except Exception as e:
+            logging.warning(f"Could not save discovery registry {path}: {e}")
 
     async def log_mqtt(self, json_data):
+        if self.mqtt_client is None:  # reconnecting, see main.mqtt_connection()
+            logging.warning("MQTT not connected")
+            return False
         logging.info(f"Logging {json_data['__device']} to MQTT")
         device_name = json_data["__device"]
         device_model = json_data["model"]
         topic = f"renogy/{device_model}/{device_name}"
 
-        # Create Home Assistant device if new device
-        if device_name not in self.published_devices:
+        # Create Home Assistant device if new device (or new field set)
+        entities = tuple(
+            field for field in json_data if field not in DISCOVERY_SKIP_FIELDS
+        )
+        if (device_name, device_model, entities) not in self.published_devices:
             await self.create_mqtt_device(json_data, device_name, device_model, topic)
+
+        messages, commit = {topic: json_data}, None
+        if self.mqtt_delta or self.mqtt_field_topics:
+            messages, commit = self.mqtt_messages(topic, json_data)
         # Publish metrics to MQTT
         try:
-            await self.mqtt_client.publish(
-                topic,
-                payload=json.dumps(json_data),
-                qos=0,
-                retain=True,
-            )
+            for message_topic, payload in messages.items():
+                await self.mqtt_client.publish(
+                    message_topic,
+                    # per-field topics carry plain strings, not json strings
+                    payload=(
+                        payload if isinstance(payload, str) else json.dumps(payload)
+                    ),
+                    qos=0,
+                    retain=True,
+                )
         except Exception as e:
             logging.error(f"MQTT connection error: {e}")
+            return False
+        if commit:  # only now subscribers have seen the changes
+            commit()
 
+    # Topic => payload to publish for a reading in delta and/or per-field mode,
+    # plus the call that commits the changes to the delta filter once published
+    def mqtt_messages(self, topic, json_data):
+        if not self.mqtt_delta:
+            changed, commit = json_data, None
+        else:
+            now = time.monotonic()
+            changed = self.delta_filter.changes(topic, json_data, now)
+            commit = functools.partial(
+                self.delta_filter.commit,
+                topic,
+                changed,
+                self.delta_filter.refresh_due(topic, now),
+                now,
+            )
+            logging.debug(f"{topic}: {len(changed)} of {len(json_data)} fields changed")
+        if self.mqtt_field_topics:
+            messages = {
+                f"{topic}/{field}": value
+                for field, value in changed.items()
+                if field not in DISCOVERY_SKIP_FIELDS
+            }
+            return messages, commit
+        # one json document per device, republished with the last sent values
+        # of unchanged fields whenever anything moved beyond its deadband
+        if not changed:
+            return {}, commit
+        return {topic: self.delta_filter.state(topic, changed)}, commit
+
+    # Buffers the reading and uploads completed status intervals in one batch,
+    # at most every pvoutput.min_interval secs. Unsent intervals stay buffered.
     async def log_pvoutput(self, json_data):
-        date_time = datetime.now().strftime("d=%Y%m%d&t=%H:%M")
-        data = f"{date_time}&v1={json_data['power_generation_today']}&v2={json_data['pv_power']}&v3={json_data['power_consumption_today']}&v4={json_data['load_power']}&v5={json_data['controller_temperature']}&v6={json_data['battery_voltage']}"
+        self.pvoutput.add(json_data)
+        min_interval = self.config["pvoutput"].get(
+            "min_interval", PVOUTPUT_MIN_INTERVAL
+        )
+        if (
+            self.pvoutput_last_post is not None
+            and time.monotonic() - self.pvoutput_last_post < min_interval
+        ):
+            return True
+        ends = self.pvoutput.ready()
+        if not ends:
+            return True
+
+        self.pvoutput_last_post = time.monotonic()
+        url = self.config["pvoutput"].get("url", PVOUTPUT_BASE_URL) + BATCH_STATUS_PATH
         headers = {
             "Content-Type": "application/x-www-form-urlencoded",
             "X-Pvoutput-Apikey": self.config["pvoutput"]["api_key"],
             "X-Pvoutput-SystemId": self.config["pvoutput"]["system_id"],
         }
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                PVOUTPUT_URL, data=data, headers=headers
-            ) as response:
+        data = f"data={self.pvoutput.format(ends)}"
+        try:
+            async with self.session.post(url, data=data, headers=headers) as response:
                 if response.status == 200:
-                    logging.info("pvoutput 200")
+                    logging.info(f"pvoutput 200, {len(ends)} statuses")
+                    self.pvoutput.remove(ends)
                 else:
                     logging.error(f"pvoutput error {response.status}")
+        except Exception as e:
+            logging.error(f"pvoutput error {e}")
+        return True
@@ -0,0 +1,63 @@
+import time
+
+# Remembers the last published value of every field per device and reports only
+# the fields that moved beyond their deadband, so unchanged readings (e.g. pv_*
+# sitting at zero all night) are not republished. A field changes when
+# |new - last| > max(abs, rel * |last|); non numeric fields when they differ.
+# Every `refresh_interval` secs all fields are reported again. changes() only
+# computes the diff, commit() records it once it was actually published, so a
+# failed publish reports the same changes again on the next try.
+# Deadband example: {'battery_voltage': {'abs': 0.1}, 'pv_power': {'rel': 0.05}}
+
+DEFAULT_REFRESH_INTERVAL = 300  # (seconds)
+
+
+class DeltaFilter:
+    def __init__(
+        self,
+        deadbands=None,
+        default_abs=0,
+        default_rel=0,
+        refresh_interval=DEFAULT_REFRESH_INTERVAL,
+    ):
+        self.deadbands = deadbands or {}
+        self.default = {"abs": default_abs, "rel": default_rel}
+        self.refresh_interval = refresh_interval
+        self.published = {}  # key => {field: last published value}
+        self.refreshed_at = {}  # key => time of the last full refresh
+
+    # Fields to publish, every field of the reading when a refresh is due
+    def changes(self, key, reading, now=None):
+        if self.refresh_due(key, now):
+            return dict(reading)
+        last = self.published.get(key, {})
+        changed = {}
+        for field, value in reading.items():
+            if field not in last or self.__changed(field, last[field], value):
+                changed[field] = value
+        return changed
+
+    def refresh_due(self, key, now=None):
+        now = time.monotonic() if now is None else now
+        return (
+            now - self.refreshed_at.get(key, -self.refresh_interval)
+            >= self.refresh_interval
+        )
+
+    # Records published changes, `refreshed` if they were a full refresh
+    def commit(self, key, changed, refreshed=False, now=None):
+        self.published.setdefault(key, {}).update(changed)
+        if refreshed:
+            self.refreshed_at[key] = time.monotonic() if now is None else now
+
+    # Last published value of every field (plus `pending` changes), i.e. what
+    # subscribers currently see
+    def state(self, key, pending=None):
+        return {**self.published.get(key, {}), **(pending or {})}
+
+    def __changed(self, field, old, new):
+        if not isinstance(new, (int, float)) or not isinstance(old, (int, float)):
+            return new != old
+        deadband = self.deadbands.get(field, self.default)
+        threshold = max(deadband.get("abs", 0), deadband.get("rel", 0) * abs(old))
+        return abs(new - old) > threshold if threshold else new != old
@@ -0,0 +1,137 @@
+import asyncio
+import logging
+import time
+from .BLEManager import BleakBackend, matches_config
+from .Metrics import ADVERTISEMENTS
+
+# Scans continuously in the background and keeps a live registry of advertising
+# devices (MAC => BLEDevice, RSSI, last seen), so clients resolve their device
+# instantly instead of running a blocking discovery every cycle. Configured
+# devices get their 'bleak_device' filled in as soon as they advertise.
+# The scanner doubles as the connect lock (config['lock']): while a connection
+# is being set up scanning is paused, as many adapters cannot do both at once.
+# One scanner runs per adapter and looks after its own list of config devices.
+# Only configured devices are kept (phones and beacons rotate random MACs). A
+# device silent for `stale_after` secs while not connected loses its
+# 'bleak_device', so it is reported missing and resolved again once heard.
+
+STALE_AFTER = 300  # (seconds)
+
+
+class DeviceScanner:
+    def __init__(
+        self, config, devices=None, adapter=None, backend=None, stale_after=STALE_AFTER
+    ):
+        self.config = config
+        self.config_devices = config["devices"] if devices is None else devices
+        self.adapter = adapter
+        self.backend = backend or BleakBackend()
+        self.stale_after = stale_after
+        # MAC => {'device': BLEDevice, 'rssi': int, 'last_seen': float}
+        self.devices = {}
+        self.lock = asyncio.Lock()
+        self.scanner = None
+        self.scanning = False
+        self.all_found = asyncio.Event()
+
+    async def start(self):
+        self.scanner = self.backend.create_scanner(
+            self.__on_advertisement, adapter=self.adapter
+        )
+        await self.__resume()
+
+    async def stop(self):
+        await self.__pause()
+
+    # Waits until every configured device was seen once (or the timeout passed)
+    async def wait_for_devices(self, timeout):
+        try:
+            await asyncio.wait_for(self.all_found.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    # Registry entry of a config device, matched by MAC or alias
+    def lookup(self, config_device):
+        entry = self.devices.get(config_device["mac_addr"].upper())
+        if entry:
+            return entry
+        for entry in self.devices.values():
+            if matches_config(entry["device"], config_device):
+                return entry
+        return None
+
+    def missing(self):
+        return [d for d in self.config_devices if not d.get("bleak_device")]
+
+    # Drops the devices that stopped advertising without being connected
+    def expire_stale(self):
+        now = time.monotonic()
+        links = self.config.get("links") or {}
+        for config_device in self.config_devices:
+            device = config_device.get("bleak_device")
+            entry = device and self.devices.get(device.address.upper())
+            if not entry or now - entry["last_seen"] <= self.stale_after:
+                continue
+            link = links.get(config_device["mac_addr"].upper())
+            if link is not None and link.is_connected:
+                continue  # connected devices usually stop advertising
+            logging.warning(
+                f"{config_device['alias']} not heard for {self.stale_after}s, "
+                "resolving it again"
+            )
+            del self.devices[device.address.upper()]
+            config_device["bleak_device"] = None
+            self.all_found.clear()
+
+    async def __aenter__(self):
+        await self.lock.acquire()
+        try:
+            await self.__pause()
+        except BaseException:
+            self.lock.release()
+            raise
+
+    async def __aexit__(self, *exc_info):
+        try:
+            await self.__resume()
+        finally:
+            self.lock.release()
+
+    async def __pause(self):
+        if self.scanner and self.scanning:
+            self.scanning = False
+            try:
+                await self.scanner.stop()
+            except Exception as e:
+                logging.warning(f"Could not pause scanning: {e}")
+
+    async def __resume(self):
+        if self.scanner and not self.scanning:
+            try:
+                await self.scanner.start()
+                self.scanning = True
+            except Exception as e:
+                logging.warning(f"Could not resume scanning: {e}")
+
+    def __on_advertisement(self, device, advertisement):
+        ADVERTISEMENTS.inc(adapter=self.adapter or "default")
+        # every configured device, also those another adapter may be assigned
+        if not any(
+            matches_config(device, d)
+            for d in self.config.get("devices", self.config_devices)
+        ):
+            return
+        self.devices[device.address.upper()] = {
+            "device": device,
+            "rssi": advertisement.rssi,
+            "last_seen": time.monotonic(),
+        }
+        for config_device in self.config_devices:
+            if matches_config(device, config_device):
+                if not config_device.get("bleak_device"):
+                    logging.info(
+                        f"Found matching device {device.name} => {device.address}"
+                    )
+                config_device["bleak_device"] = device
+        if not self.missing():
+            self.all_found.set()
@@ -0,0 +1,186 @@
+import time
+from collections import deque
+from datetime import datetime
+
+# Turns the power readings of every device into energy as they come in, so
+# downstream systems get kWh and rollups without reprocessing raw readings.
+# Power is integrated with the trapezoid rule between two readings of a device
+# (linear between polls, so a missed poll is interpolated). Intervals longer than
+# `max_gap` are not integrated, their length is reported as gap_seconds instead
+# of guessing the energy of an outage. Energy is split at bucket boundaries into
+# minute/hour/day buckets (local time) per device and for the whole site; an
+# update only touches the open buckets. Device buckets close with the device's
+# next reading in a later bucket, site buckets once every reading that can fall
+# into them has arrived (max_gap past their end). Closed buckets of the
+# `publish` periods come back from update() as derived readings:
+# {'__device': 'site-energy-hour', 'period': 'hour', 'period_start': '...',
+#  'produced_wh': .., 'consumed_wh': .., 'charged_wh': .., 'discharged_wh': ..,
+#  'gap_seconds': ..}
+
+SITE = "site"
+PERIODS = {"minute": 60, "hour": 3600, "day": 86400}
+HISTORY = {"minute": 60, "hour": 48, "day": 31}  # closed buckets kept per scope
+DEFAULT_MAX_GAP = 600  # (seconds)
+DEFAULT_PUBLISH = ("hour", "day")
+ENERGY_MODEL = "renogy-bt-energy"
+
+
+def battery_charge_power(data):
+    if "current" in data and "voltage" in data:
+        return max(0, data["current"] * data["voltage"])
+
+
+def battery_discharge_power(data):
+    if "current" in data and "voltage" in data:
+        return max(0, -data["current"] * data["voltage"])
+
+
+# client => quantity => power field (or function of the reading), in W
+POWER_SOURCES = {
+    "RoverClient": {"produced": "pv_power", "consumed": "load_power"},
+    "InverterClient": {"produced": "solar_power", "consumed": "load_power"},
+    "BatteryClient": {
+        "charged": battery_charge_power,
+        "discharged": battery_discharge_power,
+    },
+}
+QUANTITIES = ("produced", "consumed", "charged", "discharged")
+
+
+def bucket_start(timestamp, period):
+    if period == "minute":
+        return timestamp - timestamp % 60
+    moment = datetime.fromtimestamp(timestamp)
+    if period == "hour":
+        return moment.replace(minute=0, second=0, microsecond=0).timestamp()
+    return moment.replace(hour=0, minute=0, second=0, microsecond=0).timestamp()
+
+
+# start of the following bucket, also right across DST changes
+def bucket_end(start, period):
+    return bucket_start(start + PERIODS[period] * 1.5, period)
+
+
+class Rollup:
+    def __init__(self, lateness=0):
+        self.lateness = lateness  # how long after its end a bucket may still grow
+        self.open = {period: {} for period in PERIODS}  # start => [end, totals]
+        self.closed = {period: deque(maxlen=HISTORY[period]) for period in PERIODS}
+
+    # Adds `amount(a, b)` of [start, end) to the buckets it overlaps
+    def add(self, quantity, start, end, amount):
+        for period, buckets in self.open.items():
+            t = start
+            while t < end:
+                # usually one open bucket per period, cheaper than bucket_start()
+                bucket = next((b for s, b in buckets.items() if s <= t < b[0]), None)
+                if bucket is None:
+                    first = bucket_start(t, period)
+                    bucket = buckets[first] = [bucket_end(first, period), {}]
+                until = min(bucket[0], end)
+                totals = bucket[1]
+                totals[quantity] = totals.get(quantity, 0) + amount(t, until)
+                t = until
+
+    # Closes the buckets that can no longer grow, returns (period, start, totals)
+    def close(self, now):
+        closed = []
+        for period, buckets in self.open.items():
+            for start in [s for s, b in buckets.items() if b[0] + self.lateness <= now]:
+                totals = buckets.pop(start)[1]
+                self.closed[period].append((start, totals))
+                closed.append((period, start, totals))
+        return closed
+
+    def current(self):
+        return {
+            period: {start: dict(b[1]) for start, b in buckets.items()}
+            for period, buckets in self.open.items()
+        }
+
+
+class EnergyIntegrator:
+    def __init__(self, max_gap=DEFAULT_MAX_GAP, publish=DEFAULT_PUBLISH):
+        self.max_gap = max_gap
+        self.publish = set(publish)
+        self.last = {}  # device => (timestamp, {quantity: watts})
+        self.rollups = {SITE: Rollup(lateness=max_gap)}
+        self.totals = {}  # device => {quantity: Wh since start}
+
+    def powers(self, data):
+        sources = POWER_SOURCES.get(data.get("__client"), {})
+        powers = {}
+        for quantity, source in sources.items():
+            value = source(data) if callable(source) else data.get(source)
+            if isinstance(value, (int, float)):
+                powers[quantity] = value
+        return powers
+
+    # Integrates a reading, returns the derived readings of the closed buckets
+    def update(self, data, timestamp=None):
+        device = data.get("__device")
+        powers = self.powers(data)
+        if device is None or not powers:
+            return []
+        now = time.time() if timestamp is None else timestamp
+        rollup = self.rollups.get(device)
+        if rollup is None:
+            rollup = self.rollups[device] = Rollup()
+        site = self.rollups[SITE]
+        previous = self.last.get(device)
+        self.last[device] = (now, powers)
+        if previous is not None and previous[0] < now:
+            then, before = previous
+            if now - then > self.max_gap:
+                for target in (rollup, site):
+                    target.add("gap_seconds", then, now, lambda a, b: b - a)
+            else:
+                totals = self.totals.setdefault(device, {})
+                for quantity, power in powers.items():
+                    if quantity not in before:
+                        continue
+                    amount = self.trapezoid(then, before[quantity], now, power)
+                    rollup.add(quantity, then, now, amount)
+                    site.add(quantity, then, now, amount)
+                    totals[quantity] = totals.get(quantity, 0) + amount(then, now)
+        return [
+            self.reading(scope, period, start, totals)
+            for scope, target in ((device, rollup), (SITE, site))
+            for period, start, totals in target.close(now)
+            if period in self.publish
+        ]
+
+    # Wh between a and b of a power ramping linearly from p0 at t0 to p1 at t1
+    @staticmethod
+    def trapezoid(t0, p0, t1, p1):
+        slope = (p1 - p0) / (t1 - t0)
+
+        def amount(a, b):
+            return (p0 + slope * ((a + b) / 2 - t0)) * (b - a) / 3600
+
+        return amount
+
+    @staticmethod
+    def reading(scope, period, start, totals):
+        reading = {
+            "function": "ENERGY",
+            "model": ENERGY_MODEL,
+            "period": period,
+            "period_start": datetime.fromtimestamp(start).isoformat(),
+        }
+        for quantity in QUANTITIES:
+            if quantity in totals:
+                reading[f"{quantity}_wh"] = round(totals[quantity], 3)
+        reading["gap_seconds"] = round(totals.get("gap_seconds", 0))
+        reading["__device"] = f"{scope}-energy-{period}"
+        return reading
+
+    # Open (still growing) buckets of a device or the site, in Wh
+    def current(self, scope=SITE):
+        rollup = self.rollups.get(scope)
+        return rollup.current() if rollup else {}
+
+    # Closed buckets of a device or the site, oldest first
+    def history(self, scope=SITE, period="hour"):
+        rollup = self.rollups.get(scope)
+        return list(rollup.closed[period]) if rollup else []
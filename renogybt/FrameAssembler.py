@@ -0,0 +1,73 @@
+import logging
+from .Utils import crc16_modbus
+
+# Reassembles Modbus RTU frames from BLE notifications. A response may arrive
+# split over several notifications or several responses in one, so bytes are
+# buffered and only complete frames with a valid CRC are handed out. On garbage
+# or a CRC mismatch the assembler slides forward one byte until it finds the
+# next valid frame (a resync).
+
+# drop buffered bytes beyond this, no Renogy frame is that long (bytes)
+MAX_BUFFER = 512
+
+
+# Length of the frame starting at buf[pos], or None until enough bytes are in.
+# Returns 0 if buf[pos] cannot be the start of a frame.
+def frame_length(buf, pos, available):
+    if available < 3:
+        return None
+    function = buf[pos + 1]
+    if function & 0x80:  # exception response: address, function, code, crc
+        return 5
+    if function == 3:  # read response: address, function, byte count, data, crc
+        byte_count = buf[pos + 2]
+        return 0 if byte_count & 1 else 5 + byte_count  # always whole registers
+    if function == 6:  # write response echoes address, register and value
+        return 8
+    return 0
+
+
+class FrameAssembler:
+    def __init__(self, max_buffer=MAX_BUFFER):
+        self.buffer = bytearray()
+        self.max_buffer = max_buffer
+        self.frames = 0
+        self.crc_errors = 0
+        self.resyncs = 0
+
+    def feed(self, data):
+        self.buffer += data
+        frames = []
+        pos = 0
+        size = len(self.buffer)
+        with memoryview(self.buffer) as view:
+            while pos < size:
+                length = frame_length(view, pos, size - pos)
+                if length is None or length > size - pos:
+                    break  # wait for the rest of the frame
+                if length and self.__crc_ok(view, pos, length):
+                    frames.append(bytes(view[pos : pos + length]))
+                    self.frames += 1
+                    pos += length
+                    continue
+                if length:
+                    self.crc_errors += 1
+                self.resyncs += 1
+                pos += 1
+        del self.buffer[:pos]
+        if len(self.buffer) > self.max_buffer:
+            logging.warning(f"FrameAssembler dropped {len(self.buffer)} buffered bytes")
+            self.reset()
+        return frames
+
+    # Discards a partial frame, e.g. left over from a request that timed out
+    def reset(self):
+        if self.buffer:
+            self.resyncs += 1
+            self.buffer.clear()
+
+    def __crc_ok(self, view, pos, length):
+        return (
+            crc16_modbus(view[pos : pos + length - 2])
+            == view[pos + length - 2 : pos + length]
+        )
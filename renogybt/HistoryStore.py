@@ -0,0 +1,73 @@
+import json
+import logging
+import os
+
+# Daily history records already fetched from each charge controller, persisted
+# to a json file so a history sync only reads the days it does not have yet.
+# Days are numbered by the controller's operating day counter (day 1 = first
+# day in service, today = operating days). A day is final once it is read after
+# its day has passed; today's record is kept but read again on every sync.
+# Entry: {'first_day': oldest day the controller still holds, 'days': {day: record}}
+
+DEFAULT_PATH = "rover_history.json"
+DEFAULT_MAX_DAYS = 365  # how far back a sync goes / records are kept
+
+
+class HistoryStore:
+    def __init__(self, path=DEFAULT_PATH, max_days=DEFAULT_MAX_DAYS):
+        self.path = path
+        self.max_days = max_days
+        self.devices = {}  # key => entry
+        self.load()
+
+    @staticmethod
+    def key(mac_address, device_id):
+        return f"{mac_address.upper()}/{device_id}"
+
+    def entry(self, key):
+        return self.devices.setdefault(key, {"first_day": 1, "days": {}})
+
+    # Past days still to fetch, newest first (today is always read on top)
+    def missing(self, key, operating_days):
+        entry = self.entry(key)
+        first = max(entry["first_day"], operating_days - self.max_days + 1, 1)
+        days = entry["days"]
+        return [
+            day
+            for day in range(operating_days - 1, first - 1, -1)
+            if not days.get(str(day), {}).get("final")
+        ]
+
+    def put(self, key, day, record, final):
+        self.entry(key)["days"][str(day)] = {**record, "final": final}
+
+    # The controller rejected `day`, it keeps nothing older than the next one
+    def set_first_day(self, key, day):
+        entry = self.entry(key)
+        entry["first_day"] = max(entry["first_day"], day)
+
+    def prune(self, key, operating_days):
+        days = self.entry(key)["days"]
+        for day in list(days):
+            if int(day) <= operating_days - self.max_days:
+                del days[day]
+
+    def load(self):
+        if not self.path or not os.path.isfile(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                self.devices = json.load(f)
+        except Exception as e:
+            logging.warning(f"Ignoring unreadable history store {self.path}: {e}")
+
+    def save(self):
+        if not self.path:
+            return
+        try:
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(self.devices, f)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            logging.warning(f"Could not save history store {self.path}: {e}")
@@ -1,6 +1,7 @@
 import logging
 from .BaseClient import BaseClient
-from .Utils import bytes_to_int
+from .Readings import make_reading
+from .RegisterDecoder import Field, RegisterDecoder
 
 FUNCTION = {3: "READ", 6: "WRITE"}
 
@@ -16,31 +17,86 @@ CHARGING_STATE = {
 
 BATTERY_TYPE = {1: "open", 2: "sealed", 3: "gel", 4: "lithium", 5: "custom"}
 
+INVERTER_STATS = RegisterDecoder(
+    [
+        Field("function", 1, 1, enum=FUNCTION),
+        Field("uei_voltage", 3, 2, scale=0.1),
+        Field("uei_current", 5, 2, scale=0.1),
+        Field("voltage", 7, 2, scale=0.1),
+        Field("load_current", 9, 2),
+        Field("frequency", 11, 2, scale=0.01),
+        Field("temperature", 13, 2, scale=0.1),
+    ]
+)
+
+SOLAR_CHARGING = RegisterDecoder(
+    [
+        Field("solar_voltage", 3, 2, scale=0.1),
+        Field("solar_current", 5, 2, scale=0.1),
+        Field("solar_power", 7, 2),
+        Field("solar_charging_state", 9, 2, enum=CHARGING_STATE),
+        Field("solar_charging_power", 11, 2),
+    ]
+)
+
+INVERTER_LOAD = RegisterDecoder(
+    [
+        Field("load_power", 3, 2),
+        Field("charging_current", 5, 2, scale=0.1),
+    ]
+)
+
+BATTERY_TYPE_INFO = RegisterDecoder(
+    [
+        Field("function", 1, 1, enum=FUNCTION),
+        Field("battery_type", 3, 2, enum=BATTERY_TYPE),
+    ]
+)
+
+
+InverterReading = make_reading(
+    "InverterReading",
+    [INVERTER_STATS, SOLAR_CHARGING, INVERTER_LOAD, BATTERY_TYPE_INFO],
+    {"model": str},
+)
+
 
 class InverterClient(BaseClient):
+    reading_class = InverterReading
+
     def __init__(self, config, on_data_callback=None):
         super().__init__(config)
         self.on_data_callback = on_data_callback
         self.data = {"function": "READ"}
         self.sections = [
             {"register": 4000, "words": 8, "parser": self.parse_inverter_stats},
-            {"register": 4311, "words": 8, "parser": self.parse_inverter_model},
-            {"register": 4329, "words": 5, "parser": self.parse_solar_charging},
+            {
+                "register": 4311,
+                "words": 8,
+                "parser": self.parse_inverter_model,
+                "static": True,
+            },
+            {
+                "register": 4329,
+                "words": 5,
+                "parser": self.parse_solar_charging,
+                "exact": SOLAR_CHARGING.exact_offsets,
+            },
             {"register": 4410, "words": 2, "parser": self.parse_inverter_load},
-            {"register": 57348, "words": 1, "parser": self.parse_battery_type},
+            {
+                "register": 57348,
+                "words": 1,
+                "parser": self.parse_battery_type,
+                "static": True,
+            },
         ]
 
+    def is_idle(self):
+        return self.data.get("solar_power") == 0
+
     def parse_inverter_stats(self, bs):
         logging.info(f"parse_inverter_stats {bs.hex()}")
-        data = {}
-        data["function"] = FUNCTION.get(bytes_to_int(bs, 1, 1))
-        data["uei_voltage"] = bytes_to_int(bs, 3, 2, scale=0.1)
-        data["uei_current"] = bytes_to_int(bs, 5, 2, scale=0.1)
-        data["voltage"] = bytes_to_int(bs, 7, 2, scale=0.1)
-        data["load_current"] = bytes_to_int(bs, 9, 2)
-        data["frequency"] = bytes_to_int(bs, 11, 2, scale=0.01)
-        data["temperature"] = bytes_to_int(bs, 13, 2, scale=0.1)
-        self.data.update(data)
+        self.data.update(INVERTER_STATS.decode(bs))
 
     def parse_inverter_model(self, bs):
         logging.info(f"parse_inverter_model {bs.hex()}")
@@ -50,23 +106,11 @@ class InverterClient(BaseClient):
 
     def parse_solar_charging(self, bs):
         logging.info(f"parse_solar_charging {bs.hex()}")
-        data = {}
-        data["solar_voltage"] = bytes_to_int(bs, 3, 2, scale=0.1)
-        data["solar_current"] = bytes_to_int(bs, 5, 2, scale=0.1)
-        data["solar_power"] = bytes_to_int(bs, 7, 2)
-        data["solar_charging_state"] = CHARGING_STATE.get(bytes_to_int(bs, 9, 2))
-        data["solar_charging_power"] = bytes_to_int(bs, 11, 2)
-        self.data.update(data)
+        self.data.update(SOLAR_CHARGING.decode(bs))
 
     def parse_inverter_load(self, bs):
         logging.info(f"parse_inverter_load {bs.hex()}")
-        data = {}
-        data["load_power"] = bytes_to_int(bs, 3, 2)
-        data["charging_current"] = bytes_to_int(bs, 5, 2, scale=0.1)
-        self.data.update(data)
+        self.data.update(INVERTER_LOAD.decode(bs))
 
     def parse_battery_type(self, bs):
-        data = {}
-        data["function"] = FUNCTION.get(bytes_to_int(bs, 1, 1))
-        data["battery_type"] = BATTERY_TYPE.get(bytes_to_int(bs, 3, 2))
-        self.data.update(data)
+        self.data.update(BATTERY_TYPE_INFO.decode(bs))
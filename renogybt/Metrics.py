@@ -0,0 +1,211 @@
+import bisect
+import logging
+import re
+from aiohttp import web
+
+# Lightweight in-process metrics: counters, gauges and histograms with labels
+# (device, section, sink...). Updating one is a dict lookup plus an add, so the
+# hooks can sit on the BLE hot path. The registry renders the Prometheus text
+# format for the /metrics endpoint (MetricsServer) and flattens into one reading
+# for the optional MQTT diagnostics device.
+# Example: RTT_SECONDS.observe(0.12, device="BT-TH-1234", register=256)
+
+DEFAULT_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+DIAGNOSTICS_DEVICE = "renogy-bt-diagnostics"
+DEFAULT_PORT = 9091
+
+
+def label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def format_labels(key, extra=None):
+    pairs = list(key) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.values = {}  # label key => value
+
+    def inc(self, amount=1, **labels):
+        key = label_key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        for key, value in self.values.items():
+            yield self.name, key, None, value
+
+    def totals(self):
+        return self.values.items()
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        self.values[label_key(labels)] = value
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.values = {}  # label key => [bucket counts..., overflow, sum, count]
+
+    def observe(self, value, **labels):
+        key = label_key(labels)
+        state = self.values.get(key)
+        if state is None:
+            state = self.values[key] = [0] * (len(self.buckets) + 3)
+        state[bisect.bisect_left(self.buckets, value)] += 1
+        state[-2] += value
+        state[-1] += 1
+
+    def samples(self):
+        for key, state in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, state):
+                cumulative += count
+                yield f"{self.name}_bucket", key, ("le", bound), cumulative
+            yield f"{self.name}_bucket", key, ("le", "+Inf"), state[-1]
+            yield f"{self.name}_sum", key, None, round(state[-2], 6)
+            yield f"{self.name}_count", key, None, state[-1]
+
+    # mean per label set, for the diagnostics reading
+    def totals(self):
+        return [
+            (key, round(state[-2] / state[-1], 4))
+            for key, state in self.values.items()
+            if state[-1]
+        ]
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = {}
+        self.collectors = []  # called before rendering, e.g. to sample queue depths
+
+    def counter(self, name, help):
+        return self.metrics.setdefault(name, Counter(name, help))
+
+    def gauge(self, name, help):
+        return self.metrics.setdefault(name, Gauge(name, help))
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS):
+        return self.metrics.setdefault(name, Histogram(name, help, buckets))
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    def collect(self):
+        for collector in self.collectors:
+            try:
+                collector()
+            except Exception as e:
+                logging.warning(f"Metrics collector failed: {e}")
+
+    def render(self):
+        self.collect()
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, key, extra, value in metric.samples():
+                lines.append(f"{name}{format_labels(key, extra)} {value}")
+        return "\n".join(lines) + "\n"
+
+    # One flat reading (counters, gauges, histogram means) for MQTT
+    def diagnostics(self):
+        self.collect()
+        reading = {"model": "renogy-bt", "__device": DIAGNOSTICS_DEVICE}
+        for metric in self.metrics.values():
+            base = metric.name.removeprefix("renogybt_")
+            for key, value in metric.totals():
+                field = "_".join([base] + [str(v) for _, v in key])
+                reading[re.sub(r"[^0-9a-z_]+", "_", field.lower())] = value
+        return reading
+
+
+REGISTRY = MetricsRegistry()
+
+CONNECT_SECONDS = REGISTRY.histogram(
+    "renogybt_connect_seconds", "BLE connect + service resolution time"
+)
+SERVICES_SECONDS = REGISTRY.histogram(
+    "renogybt_services_seconds", "Time to resolve services and subscribe"
+)
+CONNECT_FAILURES = REGISTRY.counter(
+    "renogybt_connect_failures_total", "Failed connection attempts"
+)
+LINK_DROPS = REGISTRY.counter("renogybt_link_drops_total", "Unexpected disconnects")
+CRC_ERRORS = REGISTRY.counter("renogybt_crc_errors_total", "Frames failing the CRC")
+RESYNCS = REGISTRY.counter(
+    "renogybt_resyncs_total", "Bytes skipped to find the next frame"
+)
+RTT_SECONDS = REGISTRY.histogram(
+    "renogybt_read_rtt_seconds", "Request to complete response per read"
+)
+READ_TIMEOUTS = REGISTRY.counter("renogybt_read_timeouts_total", "Reads timed out")
+POLL_SECONDS = REGISTRY.histogram("renogybt_poll_seconds", "Duration of a full poll")
+POLLS = REGISTRY.counter("renogybt_polls_total", "Polls by result")
+CACHE_HITS = REGISTRY.counter(
+    "renogybt_section_cache_hits_total", "Static sections served from the cache"
+)
+ADVERTISEMENTS = REGISTRY.counter(
+    "renogybt_advertisements_total", "Advertisements received per adapter"
+)
+CYCLE_SECONDS = REGISTRY.histogram(
+    "renogybt_cycle_seconds", "Duration of a poll cycle", (1, 2.5, 5, 10, 30, 60, 120)
+)
+SINK_SECONDS = REGISTRY.histogram(
+    "renogybt_sink_seconds", "Duration of a sink delivery attempt"
+)
+SINK_EVENTS = REGISTRY.counter(
+    "renogybt_sink_events_total", "Sink deliveries, failures, retries and drops"
+)
+QUEUE_DEPTH = REGISTRY.gauge("renogybt_sink_queue_depth", "Readings waiting per sink")
+SPOOL_BACKLOG = REGISTRY.gauge(
+    "renogybt_spool_backlog", "Spooled readings waiting for replay per sink"
+)
+SPOOL_BYTES = REGISTRY.gauge("renogybt_spool_bytes", "Spool size per sink")
+SPOOL_DRAIN_RATE = REGISTRY.gauge(
+    "renogybt_spool_drain_rate", "Readings replayed per second in the last batch"
+)
+
+
+# Serves REGISTRY in the Prometheus text format on http://host:port/metrics
+class MetricsServer:
+    def __init__(self, registry=REGISTRY, host="127.0.0.1", port=DEFAULT_PORT):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self.runner = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/metrics", self.handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+        logging.info(f"Metrics on http://{self.host}:{self.port}/metrics")
+
+    async def stop(self):
+        if self.runner:
+            await self.runner.cleanup()
+            self.runner = None
+
+    async def handle(self, request):
+        return web.Response(
+            text=self.registry.render(),
+            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+        )
@@ -0,0 +1,90 @@
+from datetime import datetime, timedelta
+
+# Buffers Rover readings and aggregates them into PVOutput status intervals so
+# they can be uploaded with addbatchstatus.jsp within the account's rate limit
+# (free accounts allow one request per minute) instead of one request per reading.
+# Power, temperature and voltage are averaged per interval, the cumulative daily
+# energy counters keep their last value.
+
+PVOUTPUT_BASE_URL = "https://pvoutput.org"
+BATCH_STATUS_PATH = "/service/r2/addbatchstatus.jsp"
+STATUS_INTERVAL = 5  # must match the system's status interval on pvoutput.org (minutes)
+BATCH_SIZE = 30  # statuses per request allowed for free accounts
+MAX_PENDING = 288  # intervals kept while pvoutput.org is unreachable (a day at 5 min)
+
+AVERAGED_FIELDS = [
+    "pv_power",
+    "load_power",
+    "controller_temperature",
+    "battery_voltage",
+]
+LAST_FIELDS = ["power_generation_today", "power_consumption_today"]
+
+
+# pvoutput treats an empty value as not reported
+def format_value(value):
+    return "" if value is None else str(value)
+
+
+class PVOutputBatcher:
+    def __init__(self, status_interval=STATUS_INTERVAL, max_pending=MAX_PENDING):
+        self.interval = timedelta(minutes=status_interval)
+        self.max_pending = max_pending
+        self.buckets = {}  # interval end => aggregate
+
+    # Interval a reading belongs to, identified by its end time like pvoutput does
+    def interval_end(self, now):
+        start = now.replace(second=0, microsecond=0)
+        minutes = self.interval.seconds // 60
+        start -= timedelta(minutes=start.minute % minutes)
+        return start + self.interval
+
+    def add(self, json_data, now=None):
+        end = self.interval_end(now or datetime.now())
+        bucket = self.buckets.get(end)
+        if bucket is None:
+            bucket = self.buckets[end] = {"count": 0}
+            for field in AVERAGED_FIELDS:
+                bucket[field] = 0
+            if len(self.buckets) > self.max_pending:
+                del self.buckets[min(self.buckets)]
+        bucket["count"] += 1
+        for field in AVERAGED_FIELDS:
+            bucket[field] += json_data.get(field) or 0
+        for field in LAST_FIELDS:
+            bucket[field] = json_data.get(field)
+
+    # Completed intervals, oldest first, at most one batch
+    def ready(self, now=None):
+        now = now or datetime.now()
+        ends = sorted(end for end in self.buckets if end <= now)
+        return ends[:BATCH_SIZE]
+
+    def remove(self, ends):
+        for end in ends:
+            self.buckets.pop(end, None)
+
+    # addbatchstatus data: date,time,v1,v2,v3,v4,v5,v6;...
+    def format(self, ends):
+        statuses = []
+        for end in ends:
+            bucket = self.buckets[end]
+            count = bucket["count"]
+            average = {field: bucket[field] / count for field in AVERAGED_FIELDS}
+            # the last interval of a day is reported at 23:59, not the next day
+            label = end - timedelta(minutes=1) if end.hour == end.minute == 0 else end
+            statuses.append(
+                ",".join(
+                    [
+                        label.strftime("%Y%m%d"),
+                        label.strftime("%H:%M"),
+                        format_value(bucket["power_generation_today"]),
+                        str(round(average["pv_power"])),
+                        format_value(bucket["power_consumption_today"]),
+                        str(round(average["load_power"])),
+                        str(round(average["controller_temperature"], 1)),
+                        str(round(average["battery_voltage"], 2)),
+                    ]
+                )
+            )
+        return ";".join(statuses)
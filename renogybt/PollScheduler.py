@@ -0,0 +1,52 @@
+import asyncio
+import logging
+import time
+from .Metrics import CYCLE_SECONDS
+
+# Polls many devices concurrently. Only connection establishment is serialized
+# (BLEManager holds config["lock"] around BleakClient.connect), so reads and
+# notifications on connected devices overlap and a cycle takes roughly as long
+# as its slowest device instead of the sum of all of them.
+
+DEFAULT_MAX_CONCURRENCY = 4  # devices polled at the same time
+DEFAULT_DEADLINE = 60  # max time a single device may take per cycle (seconds)
+
+
+class PollScheduler:
+    def __init__(
+        self, max_concurrency=DEFAULT_MAX_CONCURRENCY, deadline=DEFAULT_DEADLINE
+    ):
+        self.semaphore = asyncio.Semaphore(max(1, int(max_concurrency)))
+        self.deadline = deadline
+        self.durations = {}  # name => duration of the last poll (seconds)
+        self.cycle_duration = 0
+
+    # jobs: list of (name, coroutine function, deadline or None for the default)
+    async def run_cycle(self, jobs):
+        started = time.monotonic()
+        results = await asyncio.gather(
+            *[self.__run(name, job, deadline) for name, job, deadline in jobs]
+        )
+        self.cycle_duration = time.monotonic() - started
+        CYCLE_SECONDS.observe(self.cycle_duration)
+        if self.durations:
+            slowest = max(self.durations, key=self.durations.get)
+            logging.info(
+                f"Poll cycle of {len(jobs)} devices took {self.cycle_duration:.2f}s, "
+                f"slowest {slowest} {self.durations[slowest]:.2f}s"
+            )
+        return dict(results)
+
+    async def __run(self, name, job, deadline):
+        deadline = deadline or self.deadline
+        async with self.semaphore:
+            started = time.monotonic()
+            result = None
+            try:
+                result = await asyncio.wait_for(job(), deadline)
+            except asyncio.TimeoutError:
+                logging.warning(f"{name} missed its {deadline}s poll deadline")
+            except Exception as e:
+                logging.error(f"{name} poll failed: {e}")
+            self.durations[name] = time.monotonic() - started
+            return name, result
@@ -0,0 +1,57 @@
+from .Utils import crc16_modbus
+
+# Coalesces neighbouring register sections into as few Modbus reads as possible.
+# Sections are merged in declaration order when the next one starts at or shortly
+# after the end of the current read (at most `max_gap` unused words in between)
+# and the merged read stays within `max_words`. Overlapping or out of order
+# sections (e.g. the per-day history registers) are never merged.
+# Read example: {'register': 5000, 'words': 34, 'sections': [(section, 0), (section, 17)]}
+
+DEFAULT_MAX_READ_WORDS = 34  # largest single read the clients already rely on
+DEFAULT_MAX_GAP_WORDS = 0
+
+
+def plan_reads(
+    sections, max_words=DEFAULT_MAX_READ_WORDS, max_gap=DEFAULT_MAX_GAP_WORDS
+):
+    reads = []
+    for section in sections:
+        if reads:
+            read = reads[-1]
+            end = read["register"] + read["words"]
+            gap = section["register"] - end
+            if (
+                0 <= gap <= max_gap
+                and section["register"] + section["words"] - read["register"]
+                <= max_words
+            ):
+                read["sections"].append(
+                    (section, section["register"] - read["register"])
+                )
+                read["words"] = (
+                    section["register"] + section["words"] - read["register"]
+                )
+                continue
+        reads.append(
+            {
+                "register": section["register"],
+                "words": section["words"],
+                "sections": [(section, 0)],
+            }
+        )
+    return reads
+
+
+# Cuts a coalesced read response back into one frame per section, shaped exactly
+# like the response to an individual read so the existing parsers work unchanged.
+def split_response(read, response):
+    if len(read["sections"]) == 1:
+        return [(read["sections"][0][0], response)]
+    frames = []
+    for section, offset in read["sections"]:
+        start = 3 + offset * 2
+        frame = bytes([response[0], response[1], section["words"] * 2]) + bytes(
+            response[start : start + section["words"] * 2]
+        )
+        frames.append((section, frame + crc16_modbus(frame)))
+    return frames
@@ -0,0 +1,117 @@
+import json
+from dataclasses import dataclass, field, make_dataclass
+from typing import ClassVar, Optional
+
+# Typed, slotted reading records, one class per device type, as yielded by
+# BaseClient.stream(). Field types are derived from the register decoders
+# (enum => str, scaled => float, else int). to_dict() gives back the same dict
+# the callbacks receive (unset fields are left out, per cell arrays come back in
+# the shape they came in: lists, or cell_voltage_0, cell_voltage_1... keys),
+# to_json() its compact json encoding.
+# Records are built from the reading dict, not instead of it: parsers still fill
+# the dict the callbacks, sinks and section cache work with, and stream() adds
+# one record per poll on top (values and lists are shared, not copied).
+# Example: RoverReading.from_dict(data).pv_power
+
+
+@dataclass(slots=True)
+class Reading:
+    function: Optional[str] = None
+    device: Optional[str] = None  # '__device'
+    client: Optional[str] = None  # '__client'
+    quality: Optional[dict] = None  # '__quality'
+    extra: Optional[dict] = None  # fields the record does not know about
+    listed: Optional[set] = None  # array attributes given as lists, not _i keys
+
+    KEYS: ClassVar[tuple] = ()  # (attribute, dict key) pairs
+    ARRAYS: ClassVar[dict] = {}  # attribute => dict key prefix
+    ATTRIBUTES: ClassVar[dict] = {}  # dict key => attribute
+    PREFIXES: ClassVar[dict] = {}  # dict key prefix => array attribute
+    META: ClassVar[tuple] = (
+        ("device", "__device"),
+        ("client", "__client"),
+        ("quality", "__quality"),
+    )
+
+    @classmethod
+    def from_dict(cls, data):
+        record = cls()
+        attributes = cls.ATTRIBUTES
+        for key, value in data.items():
+            attribute = attributes.get(key)
+            if attribute is not None:
+                setattr(record, attribute, value)
+                if attribute in cls.ARRAYS:
+                    if record.listed is None:
+                        record.listed = set()
+                    record.listed.add(attribute)
+                continue
+            prefix, _, index = key.rpartition("_")
+            attribute = cls.PREFIXES.get(prefix)
+            if attribute is not None and index.isdigit():
+                values = getattr(record, attribute)
+                if values is None:
+                    values = []
+                    setattr(record, attribute, values)
+                values.append(value)
+            else:
+                if record.extra is None:
+                    record.extra = {}
+                record.extra[key] = value
+        return record
+
+    def to_dict(self):
+        data = {}
+        for attribute, key in self.KEYS:
+            value = getattr(self, attribute)
+            if value is not None:
+                data[key] = value
+        for attribute, prefix in self.ARRAYS.items():
+            values = getattr(self, attribute)
+            if values is None:
+                continue
+            if self.listed and attribute in self.listed:
+                data[attribute] = values
+                continue
+            for i, value in enumerate(values):
+                data[f"{prefix}_{i}"] = value
+        if self.extra:
+            data.update(self.extra)
+        for attribute, key in self.META:
+            value = getattr(self, attribute)
+            if value is not None:
+                data[key] = value
+        return data
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), separators=(",", ":"))
+
+
+def field_type(decoder_field):
+    if decoder_field.enum is not None:
+        return str
+    return float if decoder_field.scale != 1 else int
+
+
+# Builds the record class of a device type from its decoders plus extra fields
+def make_reading(name, decoders=(), fields=(), arrays=None):
+    definitions = {"function": str}
+    for decoder in decoders:
+        for decoder_field in decoder.fields:
+            definitions.setdefault(decoder_field.name, field_type(decoder_field))
+    definitions.update(fields)
+    del definitions["function"]  # already on Reading
+    arrays = arrays or {}
+    cls = make_dataclass(
+        name,
+        [(n, Optional[t], field(default=None)) for n, t in definitions.items()]
+        + [(n, Optional[list], field(default=None)) for n in arrays],
+        bases=(Reading,),
+        slots=True,
+    )
+    cls.KEYS = (("function", "function"),) + tuple((n, n) for n in definitions)
+    cls.ARRAYS = arrays
+    cls.ATTRIBUTES = {key: attribute for attribute, key in cls.KEYS + cls.META}
+    cls.ATTRIBUTES.update({attribute: attribute for attribute in arrays})
+    cls.PREFIXES = {prefix: attribute for attribute, prefix in arrays.items()}
+    return cls
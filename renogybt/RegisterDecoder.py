@@ -0,0 +1,96 @@
+import struct
+from collections import namedtuple
+
+# Declarative register decoding. Each section describes its fields once and the
+# table is compiled into a single struct.Struct, so a response is decoded with one
+# unpack_from call instead of slicing and converting every field separately.
+# Offsets are byte offsets into the response frame, same as with bytes_to_int.
+# Field example: Field("battery_voltage", 5, 2, scale=0.1)
+
+Field = namedtuple(
+    "Field",
+    ["name", "offset", "width", "signed", "scale", "enum"],
+    defaults=(False, 1, None),
+)
+
+FORMATS = {
+    (1, False): "B",
+    (1, True): "b",
+    (2, False): "H",
+    (2, True): "h",
+    (4, False): "I",
+    (4, True): "i",
+}
+
+
+class RegisterDecoder:
+    def __init__(self, fields):
+        fmt = ">"
+        position = 0
+        order = sorted(range(len(fields)), key=lambda i: fields[i].offset)
+        for i in order:
+            field = fields[i]
+            if field.offset < position:
+                raise ValueError(f"Field {field.name} overlaps the previous field")
+            fmt += (
+                "x" * (field.offset - position) + FORMATS[(field.width, field.signed)]
+            )
+            position = field.offset + field.width
+        self.struct = struct.Struct(fmt)
+        self.size = self.struct.size
+        self.fields = tuple(fields)
+        # bytes of enum/status and byte-packed fields, never compared with tolerance
+        self.exact_offsets = tuple(
+            sorted(
+                field.offset + i
+                for field in fields
+                if field.enum is not None or field.width == 1
+                for i in range(field.width)
+            )
+        )
+
+        # output keeps the declaration order, values come in offset order
+        index = {field_index: n for n, field_index in enumerate(order)}
+        self.plain = []
+        self.scaled = []
+        self.mapped = []
+        self.names = tuple(field.name for field in fields)
+        for n, field in enumerate(fields):
+            if field.enum is not None:
+                self.mapped.append((n, index[n], field.enum))
+            elif field.scale != 1:
+                self.scaled.append((n, index[n], field.scale))
+            else:
+                self.plain.append((n, index[n]))
+
+    def decode(self, bs):
+        if len(bs) < self.size:  # missing bytes decode as 0, like bytes_to_int
+            bs = bytes(bs).ljust(self.size, b"\0")
+        raw = self.struct.unpack_from(bs)
+        values = [None] * len(self.names)
+        for n, i in self.plain:
+            values[n] = raw[i]
+        for n, i, scale in self.scaled:
+            values[n] = round(raw[i] * scale, 2)
+        for n, i, enum in self.mapped:
+            values[n] = enum.get(raw[i])
+        return dict(zip(self.names, values))
+
+
+# Decodes `count` consecutive registers starting at `offset`, e.g. cell voltages
+class ArrayDecoder:
+    def __init__(self, offset, count, width=2, signed=False, scale=1):
+        self.offset = offset
+        self.count = count
+        self.scale = scale
+        self.struct = struct.Struct(">" + FORMATS[(width, signed)] * count)
+        self.size = offset + self.struct.size
+
+    def decode(self, bs, count=None):
+        if len(bs) < self.size:
+            bs = bytes(bs).ljust(self.size, b"\0")
+        raw = self.struct.unpack_from(bs, self.offset)[:count]
+        if self.scale == 1:
+            return list(raw)
+        scale = self.scale
+        return [round(value * scale, 2) for value in raw]
@@ -0,0 +1,67 @@
+import asyncio
+import time
+
+# Paces Modbus requests from the measured round trip time instead of fixed sleeps.
+# The smoothed RTT and its variance are tracked like TCP does (RFC 6298): the next
+# request goes out as soon as the previous response is in, only waiting for a small
+# per-device gap, and the read timeout follows the link instead of a constant.
+
+RTT_ALPHA = 0.125  # weight of a new sample in the smoothed RTT
+RTT_BETA = 0.25  # weight of a new sample in the RTT variance
+MIN_REQUEST_GAP = 0.05  # never send the next request sooner than this (seconds)
+GAP_RTT_FACTOR = 0.25  # slower modules get proportionally more breathing room
+MIN_TIMEOUT = 1.5  # (seconds)
+MAX_TIMEOUT = 15  # also used until the first response is measured (seconds)
+
+
+class RequestPacer:
+    def __init__(self, min_gap=MIN_REQUEST_GAP, max_timeout=MAX_TIMEOUT):
+        self.min_gap = min_gap
+        self.max_timeout = max_timeout
+        self.srtt = None
+        self.rttvar = 0
+        self.backoff = 1
+        self.sent_at = None
+        self.received_at = 0
+
+    def on_request(self):
+        self.sent_at = time.monotonic()
+
+    # Returns the measured round trip time, None if no request was pending
+    def on_response(self):
+        self.received_at = time.monotonic()
+        if self.sent_at is None:
+            return None
+        sample = self.received_at - self.sent_at
+        self.sent_at = None
+        self.backoff = 1
+        if self.srtt is None:
+            self.srtt = sample
+            self.rttvar = sample / 2
+        else:
+            self.rttvar += RTT_BETA * (abs(self.srtt - sample) - self.rttvar)
+            self.srtt += RTT_ALPHA * (sample - self.srtt)
+        return sample
+
+    def on_timeout(self):
+        # a lost response says nothing about the RTT, just back the timeout off
+        self.sent_at = None
+        self.backoff = min(self.backoff * 2, 8)
+
+    @property
+    def gap(self):
+        if self.srtt is None:
+            return self.min_gap
+        return max(self.min_gap, self.srtt * GAP_RTT_FACTOR)
+
+    @property
+    def timeout(self):
+        if self.srtt is None:
+            return self.max_timeout
+        timeout = (self.srtt + 4 * self.rttvar) * self.backoff
+        return min(max(timeout, MIN_TIMEOUT), self.max_timeout)
+
+    async def wait(self):
+        remaining = self.received_at + self.gap - time.monotonic()
+        if remaining > 0:
+            await asyncio.sleep(remaining)
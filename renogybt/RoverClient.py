@@ -1,11 +1,13 @@
 import logging
 import asyncio
 from .BaseClient import BaseClient
+from .Readings import make_reading
+from .RegisterDecoder import Field, RegisterDecoder
 from .Utils import bytes_to_int, parse_temperature
 
 # Read and parse BT-1 RS232 type bluetooth module connected to Renogy Rover/Wanderer/Adventurer
 # series charge controllers. Also works with BT-2 RS485 module on Rover Elite, DC Charger etc.
-# Does not support Communication Hub with multiple devices connected
+# Devices behind a Communication Hub share one connection, see BaseClient.create_ble_manager
 
 FUNCTION = {3: "READ", 6: "WRITE"}
 
@@ -23,18 +25,83 @@ LOAD_STATE = {0: "off", 1: "on"}
 
 BATTERY_TYPE = {1: "open", 2: "sealed", 3: "gel", 4: "lithium", 5: "custom"}
 
+CHARGING_INFO = RegisterDecoder(
+    [
+        Field("function", 1, 1, enum=FUNCTION),
+        Field("battery_percentage", 3, 2),
+        Field("battery_voltage", 5, 2, scale=0.1),
+        Field("battery_current", 7, 2, scale=0.01),
+        Field("battery_temperature", 10, 1),
+        Field("controller_temperature", 9, 1),
+        Field("load_status", 67, 1),
+        Field("load_voltage", 11, 2, scale=0.1),
+        Field("load_current", 13, 2, scale=0.01),
+        Field("load_power", 15, 2),
+        Field("pv_voltage", 17, 2, scale=0.1),
+        Field("pv_current", 19, 2, scale=0.01),
+        Field("pv_power", 21, 2),
+        Field("max_charging_power_today", 33, 2),
+        Field("max_discharging_power_today", 35, 2),
+        Field("charging_amp_hours_today", 37, 2),
+        Field("discharging_amp_hours_today", 39, 2),
+        Field("power_generation_today", 41, 2),
+        Field("power_consumption_today", 43, 2),
+        Field("power_generation_total", 59, 4),
+        Field("charging_status", 68, 1, enum=CHARGING_STATE),
+    ]
+)
+
+BATTERY_TYPE_INFO = RegisterDecoder(
+    [
+        Field("function", 1, 1, enum=FUNCTION),
+        Field("battery_type", 3, 2, enum=BATTERY_TYPE),
+    ]
+)
+
+
+RoverReading = make_reading(
+    "RoverReading",
+    [CHARGING_INFO, BATTERY_TYPE_INFO],
+    {"model": str, "device_id": int},
+)
+
 
 class RoverClient(BaseClient):
+    reading_class = RoverReading
+
     def __init__(self, config, on_data_callback=None):
         super().__init__(config)
         self.on_data_callback = on_data_callback
         self.data = {}
         self.sections = [
-            {"register": 12, "words": 8, "parser": self.parse_device_info},
-            {"register": 26, "words": 1, "parser": self.parse_device_address},
-            {"register": 256, "words": 34, "parser": self.parse_charging_info},
-            {"register": 57348, "words": 1, "parser": self.parse_battery_type},
+            {
+                "register": 12,
+                "words": 8,
+                "parser": self.parse_device_info,
+                "static": True,
+            },
+            {
+                "register": 26,
+                "words": 1,
+                "parser": self.parse_device_address,
+                "static": True,
+            },
+            {
+                "register": 256,
+                "words": 34,
+                "parser": self.parse_charging_info,
+                "exact": CHARGING_INFO.exact_offsets,
+            },
+            {
+                "register": 57348,
+                "words": 1,
+                "parser": self.parse_battery_type,
+                "static": True,
+            },
         ]
+        # registers 20-25 (software/hardware version, serial) sit between the
+        # model and the device address, so both are fetched in one read
+        self.max_gap_words = 6
         self.set_load_params = {"function": 6, "register": 266}
 
     async def on_data_received(self, response):
@@ -50,7 +117,7 @@ class RoverClient(BaseClient):
     def on_write_operation_complete(self):
         logging.info("on_write_operation_complete")
         if self.on_data_callback is not None:
-            asyncio.create_task(self.on_data_callback(self, self.data))
+            self.create_task(self.on_data_callback(self, self.data))
 
     async def set_load(self, value=0):
         logging.info(f"setting load {value}")
@@ -74,40 +141,23 @@ class RoverClient(BaseClient):
         self.data.update(data)
 
     def parse_charging_info(self, bs):
-        data = {}
+        data = CHARGING_INFO.decode(bs)
         temp_unit = self.config["data"]["temperature_unit"]
-        data["function"] = FUNCTION.get(bytes_to_int(bs, 1, 1))
-        data["battery_percentage"] = bytes_to_int(bs, 3, 2)
-        data["battery_voltage"] = bytes_to_int(bs, 5, 2, scale=0.1)
-        data["battery_current"] = bytes_to_int(bs, 7, 2, scale=0.01)
         data["battery_temperature"] = parse_temperature(
-            bytes_to_int(bs, 10, 1), temp_unit
+            data["battery_temperature"], temp_unit
         )
         data["controller_temperature"] = parse_temperature(
-            bytes_to_int(bs, 9, 1), temp_unit
+            data["controller_temperature"], temp_unit
         )
-        data["load_status"] = LOAD_STATE.get(bytes_to_int(bs, 67, 1) >> 7)
-        data["load_voltage"] = bytes_to_int(bs, 11, 2, scale=0.1)
-        data["load_current"] = bytes_to_int(bs, 13, 2, scale=0.01)
-        data["load_power"] = bytes_to_int(bs, 15, 2)
-        data["pv_voltage"] = bytes_to_int(bs, 17, 2, scale=0.1)
-        data["pv_current"] = bytes_to_int(bs, 19, 2, scale=0.01)
-        data["pv_power"] = bytes_to_int(bs, 21, 2)
-        data["max_charging_power_today"] = bytes_to_int(bs, 33, 2)
-        data["max_discharging_power_today"] = bytes_to_int(bs, 35, 2)
-        data["charging_amp_hours_today"] = bytes_to_int(bs, 37, 2)
-        data["discharging_amp_hours_today"] = bytes_to_int(bs, 39, 2)
-        data["power_generation_today"] = bytes_to_int(bs, 41, 2)
-        data["power_consumption_today"] = bytes_to_int(bs, 43, 2)
-        data["power_generation_total"] = bytes_to_int(bs, 59, 4)
-        data["charging_status"] = CHARGING_STATE.get(bytes_to_int(bs, 68, 1))
+        data["load_status"] = LOAD_STATE.get(data["load_status"] >> 7)
         self.data.update(data)
 
     def parse_battery_type(self, bs):
-        data = {}
-        data["function"] = FUNCTION.get(bytes_to_int(bs, 1, 1))
-        data["battery_type"] = BATTERY_TYPE.get(bytes_to_int(bs, 3, 2))
-        self.data.update(data)
+        self.data.update(BATTERY_TYPE_INFO.decode(bs))
+
+    # no PV (night), the readings barely move until the sun is back
+    def is_idle(self):
+        return self.data.get("pv_power") == 0
 
     def parse_set_load_response(self, bs):
         data = {}
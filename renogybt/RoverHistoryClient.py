@@ -1,30 +1,157 @@
+from datetime import date, timedelta
+from functools import partial
 from .BaseClient import BaseClient
+from .HistoryStore import DEFAULT_MAX_DAYS, DEFAULT_PATH, HistoryStore
+from .ReadPlanner import plan_reads
+from .Readings import make_reading
 from .Utils import bytes_to_int
 
 # Retrieve last 7 days of historical data from Rover/Wanderer/Adventurer
+#
+# With 'history_sync' (device or data section) the client instead syncs the full
+# daily history incrementally: it reads the operating day counter, then today's
+# record plus every past day not stored yet in the HistoryStore ('history_file',
+# at most 'history_max_days' back). Readings carry the fetched days as per-day
+# records: {'days': [{'date', 'day', 'power_generation', 'charge_ah', 'max_power'}]}
+
+HISTORY_INTERVAL = 3600  # past days never change, today's record slowly (seconds)
+HISTORY_REGISTER = 61440  # today, 61441 yesterday...
+OPERATING_DAYS_REGISTER = 277
+ILLEGAL_DATA_ADDRESS = 2  # Modbus exception of a day the controller no longer has
+
+
+RoverHistoryReading = make_reading(
+    "RoverHistoryReading",
+    fields={
+        "daily_power_generation": list,
+        "daily_charge_ah": list,
+        "daily_max_power": list,
+        "operating_days": int,
+        "days": list,
+    },
+)
 
 
 class RoverHistoryClient(BaseClient):
+    reading_class = RoverHistoryReading
+
     def __init__(self, config, on_data_callback=None):
         super().__init__(config)
         self.on_data_callback = on_data_callback
+        self.sync = bool(
+            self.config["device"].get(
+                "history_sync", self.config["data"].get("history_sync", False)
+            )
+        )
+        if self.sync:
+            self.history = self.config.get("history_store") or HistoryStore(
+                path=self.config["data"].get("history_file", DEFAULT_PATH),
+                max_days=self.config["data"].get("history_max_days", DEFAULT_MAX_DAYS),
+            )
+            self.history_key = HistoryStore.key(
+                self.config["device"]["mac_addr"], self.device_id
+            )
+            self.day_registers = {}  # register => day, of the running sync
+            self.rejected = {}  # register => Modbus exception code, of the running sync
+            # the day reads are added once the operating days are known
+            self.sections = [
+                {
+                    "register": OPERATING_DAYS_REGISTER,
+                    "words": 1,
+                    "parser": self.parse_operating_days,
+                    "interval": 0,
+                }
+            ]
+            return
         self.data = {
             "function": "READ",
             "daily_power_generation": [],
             "daily_charge_ah": [],
             "daily_max_power": [],
         }
+        # registers 61446 (oldest) down to 61440, one day each
         self.sections = [
-            {"register": 61446, "words": 10, "parser": self.parse_historical_data},
-            {"register": 61445, "words": 10, "parser": self.parse_historical_data},
-            {"register": 61444, "words": 10, "parser": self.parse_historical_data},
-            {"register": 61443, "words": 10, "parser": self.parse_historical_data},
-            {"register": 61442, "words": 10, "parser": self.parse_historical_data},
-            {"register": 61441, "words": 10, "parser": self.parse_historical_data},
-            {"register": 61440, "words": 10, "parser": self.parse_historical_data},
+            {
+                "register": HISTORY_REGISTER + day,
+                "words": 10,
+                "parser": self.parse_historical_data,
+                "interval": HISTORY_INTERVAL,
+            }
+            for day in range(6, -1, -1)
         ]
 
     def parse_historical_data(self, bs):
-        self.data["daily_power_generation"].append(bytes_to_int(bs, 19, 2))
-        self.data["daily_charge_ah"].append(bytes_to_int(bs, 15, 2))
-        self.data["daily_max_power"].append(bytes_to_int(bs, 11, 2))
+        # data is reset after every poll, the lists start over on the next one
+        self.data.setdefault("function", "READ")
+        self.data.setdefault("daily_power_generation", []).append(
+            bytes_to_int(bs, 19, 2)
+        )
+        self.data.setdefault("daily_charge_ah", []).append(bytes_to_int(bs, 15, 2))
+        self.data.setdefault("daily_max_power", []).append(bytes_to_int(bs, 11, 2))
+
+    # Queues the reads of today and of the days missing from the store
+    def parse_operating_days(self, bs):
+        operating_days = bytes_to_int(bs, 3, 2)
+        self.data["function"] = "READ"
+        self.data["operating_days"] = operating_days
+        self.data["days"] = []
+        days = [operating_days] + self.history.missing(self.history_key, operating_days)
+        self.day_registers = {
+            HISTORY_REGISTER + operating_days - day: day for day in days
+        }
+        self.rejected = {}
+        self.reads += plan_reads(
+            [
+                {
+                    "register": register,
+                    "words": 10,
+                    "parser": partial(self.parse_day_record, day, operating_days),
+                }
+                for register, day in self.day_registers.items()
+            ]
+        )
+
+    def parse_day_record(self, day, operating_days, bs):
+        record = {
+            "date": (date.today() - timedelta(days=operating_days - day)).isoformat(),
+            "day": day,
+            "power_generation": bytes_to_int(bs, 19, 2),
+            "charge_ah": bytes_to_int(bs, 15, 2),
+            "max_power": bytes_to_int(bs, 11, 2),
+        }
+        self.history.put(self.history_key, day, record, final=day < operating_days)
+        self.data.setdefault("days", []).append(record)
+
+    async def on_data_received(self, response):
+        if (
+            self.sync
+            and bytes_to_int(response, 1, 1) == 0x83
+            and self.read_index < len(self.reads)
+        ):
+            for section, _ in self.reads[self.read_index]["sections"]:
+                self.rejected[section["register"]] = response[2]
+        await super().on_data_received(response)
+
+    # The controller no longer has the oldest days if it rejected them as illegal
+    # addresses, all of them from the oldest one read on. Other exceptions (e.g.
+    # busy) and gaps in between are retried on the next sync.
+    def oldest_kept_day(self, today):
+        first = None
+        for register, day in sorted(
+            self.day_registers.items(), key=lambda item: item[1]
+        ):
+            if day >= today or self.rejected.get(register) != ILLEGAL_DATA_ADDRESS:
+                break
+            first = day + 1
+        return first
+
+    def on_read_operation_complete(self):
+        if self.sync and "operating_days" in self.data:
+            today = self.data["operating_days"]
+            first = self.oldest_kept_day(today)
+            if first is not None:
+                self.history.set_first_day(self.history_key, first)
+            self.data["days"].sort(key=lambda record: record["day"])
+            self.history.prune(self.history_key, today)
+            self.history.save()
+        super().on_read_operation_complete()
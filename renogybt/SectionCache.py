@@ -0,0 +1,57 @@
+import json
+import logging
+import os
+import time
+
+# Caches the raw responses of static sections (model, device address, battery
+# type...) per device so they are only re-read once their TTL expires. Entries
+# are optionally persisted to a json file so a restart does not re-read them.
+# Sections opt in with 'static': True in their definition.
+
+DEFAULT_TTL = 86400  # (seconds)
+
+
+class SectionCache:
+    def __init__(self, path=None, ttl=DEFAULT_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.entries = {}  # key => {'time': epoch seconds, 'frame': hex}
+        self.hits = 0
+        self.misses = 0
+        self.load()
+
+    @staticmethod
+    def key(mac_address, device_id, register):
+        return f"{mac_address.upper()}/{device_id}/{register}"
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry and time.time() - entry["time"] < self.ttl:
+            self.hits += 1
+            return bytes.fromhex(entry["frame"])
+        self.misses += 1
+        return None
+
+    def put(self, key, frame):
+        self.entries[key] = {"time": time.time(), "frame": bytes(frame).hex()}
+        self.save()
+
+    def load(self):
+        if not self.path or not os.path.isfile(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                self.entries = json.load(f)
+        except Exception as e:
+            logging.warning(f"Ignoring unreadable section cache {self.path}: {e}")
+
+    def save(self):
+        if not self.path:
+            return
+        try:
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(self.entries, f)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            logging.warning(f"Could not save section cache {self.path}: {e}")
@@ -0,0 +1,95 @@
+import time
+
+# Decides per section whether it has to be read this poll. Sections are read on
+# every poll, except those with their own 'interval' (e.g. history) and, with
+# adaptive polling, all of them: those are read every `interval` secs (their
+# own, else the poll interval); in between the last response is replayed to the
+# parser so readings stay complete without a radio round trip. With adaptive
+# polling the interval doubles every time the section comes back unchanged
+# (every register within `tolerance` of the last value and the section's
+# 'exact' byte offsets, e.g. status bytes, identical), jumps to the maximum
+# while the device is idle (e.g. no PV at night) and drops back to the base
+# interval as soon as a register moves.
+# Kept on the device config like the RequestPacer, so it outlives per-cycle
+# clients.
+
+DEFAULT_MAX_INTERVAL = 600  # longest a section is left unread (seconds)
+DEFAULT_GROWTH = 2  # interval multiplier per unchanged read
+DEFAULT_TOLERANCE = 0.02  # relative register change still considered stable
+
+
+# True if any register of the two frames differs beyond the tolerance, or any
+# of the `exact` byte offsets differs at all
+def frame_changed(old, new, tolerance=DEFAULT_TOLERANCE, exact=()):
+    if len(old) != len(new):
+        return True
+    for i in exact:
+        if i < len(new) and old[i] != new[i]:
+            return True
+    for i in range(3, len(new) - 2, 2):
+        before = (old[i] << 8) | old[i + 1]
+        after = (new[i] << 8) | new[i + 1]
+        if abs(after - before) > max(1, tolerance * before):
+            return True
+    return False
+
+
+class SectionSchedule:
+    def __init__(
+        self,
+        base_interval=0,
+        adaptive=False,
+        max_interval=DEFAULT_MAX_INTERVAL,
+        growth=DEFAULT_GROWTH,
+        tolerance=DEFAULT_TOLERANCE,
+    ):
+        self.base_interval = base_interval
+        self.adaptive = adaptive
+        self.max_interval = max_interval
+        self.growth = growth
+        self.tolerance = tolerance
+        self.idle = False  # set after every poll from the client's reading
+        self.entries = {}  # register => {'frame', 'read_at', 'interval'}
+
+    def base(self, section):
+        return section.get("interval", self.base_interval)
+
+    # Polls do not land on the second, half a poll interval early counts as on time
+    def due(self, section, now=None):
+        if not self.adaptive and "interval" not in section:
+            return True
+        entry = self.entries.get(section["register"])
+        if entry is None:
+            return True
+        now = time.monotonic() if now is None else now
+        return now >= entry["read_at"] + entry["interval"] - self.base_interval / 2
+
+    def frame(self, section):
+        entry = self.entries.get(section["register"])
+        return entry and entry["frame"]
+
+    def update(self, section, frame, now=None):
+        now = time.monotonic() if now is None else now
+        base = self.base(section)
+        entry = self.entries.get(section["register"])
+        interval = base
+        if self.adaptive and entry is not None:
+            if frame_changed(
+                entry["frame"], frame, self.tolerance, section.get("exact", ())
+            ):
+                interval = base
+            elif self.idle:
+                interval = self.max_interval
+            else:
+                interval = min(
+                    max(entry["interval"], base) * self.growth, self.max_interval
+                )
+        self.entries[section["register"]] = {
+            "frame": frame,
+            "read_at": now,
+            "interval": max(interval, base),
+        }
+
+    def interval(self, section):
+        entry = self.entries.get(section["register"])
+        return entry["interval"] if entry else self.base(section)
@@ -0,0 +1,342 @@
+import asyncio
+import logging
+import random
+from bleak import BLEDevice
+from collections import namedtuple
+from .BaseClient import NOTIFY_CHAR_UUID, WRITE_CHAR_UUID
+from .Utils import crc16_modbus
+
+# In-process stand-in for Renogy bluetooth modules, used as BLEManager backend
+# (config['backend']) so clients, scheduler and sinks can be load tested and
+# benchmarked without hardware. Every simulated BT module holds one register bank
+# per Modbus device_id (several ids = hub mode) and answers function 3 and 6
+# requests with a valid CRC after a configurable latency + jitter, split into
+# notification fragments. Requests can be dropped at random to exercise timeouts.
+# Example: backend = SimulatorBackend(); config['devices'] = backend.populate(200)
+
+DEFAULT_LATENCY = 0.05  # request => first notification (seconds)
+DEFAULT_FRAGMENT = 20  # notification payload size, the default BLE MTU (bytes)
+HISTORY_DAYS = 30  # daily history records held by a simulated controller
+
+ILLEGAL_FUNCTION = 1
+ILLEGAL_ADDRESS = 2
+
+Advertisement = namedtuple("Advertisement", ["rssi"])
+
+
+class _Characteristic:
+    def __init__(self, uuid):
+        self.uuid = uuid
+
+
+class _Service:
+    def __init__(self):
+        self.characteristics = [
+            _Characteristic(NOTIFY_CHAR_UUID),
+            _Characteristic(WRITE_CHAR_UUID),
+        ]
+
+
+# Packs a string into big endian registers, space padded
+def string_words(text, words):
+    raw = text.encode("ascii").ljust(words * 2)[: words * 2]
+    return [int.from_bytes(raw[i : i + 2], "big") for i in range(0, len(raw), 2)]
+
+
+def _rover(rng, device_id):
+    registers = {}
+    for i, word in enumerate(string_words("  RNG-CTRL-RVR40", 8)):
+        registers[12 + i] = word
+    registers[26] = device_id
+    charging = [0] * 34
+    pv_power = rng.randint(0, 400)
+    charging[0] = rng.randint(20, 100)  # battery_percentage
+    charging[1] = rng.randint(120, 140)  # battery_voltage 0.1V
+    charging[2] = rng.randint(0, 2000)  # battery_current 0.01A
+    charging[3] = (rng.randint(15, 45) << 8) | rng.randint(10, 30)  # temperatures
+    charging[7] = rng.randint(0, 220)  # pv_voltage 0.1V
+    charging[9] = pv_power
+    charging[15] = pv_power
+    charging[19] = rng.randint(0, 2000)  # power_generation_today
+    charging[21] = HISTORY_DAYS  # operating days
+    charging[29] = rng.randint(0, 60000)  # power_generation_total
+    charging[32] = (1 << 15) | 2  # load on, mppt
+    for i, word in enumerate(charging):
+        registers[256 + i] = word
+    registers[57348] = 4  # lithium
+    # day n back => 10 word record (max power @4, charge ah @6, generation @8)
+    records = {}
+    for day in range(HISTORY_DAYS):
+        record = [0] * 10
+        record[4] = rng.randint(0, 400)
+        record[6] = rng.randint(0, 100)
+        record[8] = rng.randint(0, 2000)
+        records[61440 + day] = record
+    return registers, records
+
+
+def _battery(rng, device_id):
+    cells = [4] + [rng.randint(32, 34) for _ in range(4)] + [0] * 12
+    sensors = [4] + [rng.randint(150, 350) for _ in range(4)] + [0] * 12
+    remaining = rng.randint(10000, 100000)  # mAh
+    capacity = 100000
+    info = [
+        rng.randint(0, 3000),  # current 0.01A
+        rng.randint(128, 136),  # voltage 0.1V
+        remaining >> 16,
+        remaining & 0xFFFF,
+        capacity >> 16,
+        capacity & 0xFFFF,
+    ]
+    registers = {}
+    for base, words in ((5000, cells), (5017, sensors), (5042, info)):
+        for i, word in enumerate(words):
+            registers[base + i] = word
+    for i, word in enumerate(string_words("RBT100LFP12S-G1", 8)):
+        registers[5122 + i] = word
+    registers[5223] = device_id
+    return registers, {}
+
+
+def _inverter(rng, device_id):
+    stats = [1200, 10, 1200, 2, 6000, rng.randint(250, 450), 0, 0]
+    solar = [rng.randint(0, 1000), rng.randint(0, 100), rng.randint(0, 800), 2, 0]
+    registers = {}
+    for base, words in (
+        (4000, stats),
+        (4311, string_words("RIV4835CSH1S", 8)),
+        (4329, solar),
+        (4410, [rng.randint(0, 1500), 50]),
+    ):
+        for i, word in enumerate(words):
+            registers[base + i] = word
+    registers[57348] = 4
+    return registers, {}
+
+
+PROFILES = {
+    "RNG_CTRL": _rover,
+    "RNG_CTRL_HIST": _rover,
+    "RNG_BATT": _battery,
+    "RNG_INVT": _inverter,
+}
+
+
+# One Modbus device behind a BT module
+class SimulatedUnit:
+    def __init__(self, registers=None, records=None):
+        self.registers = registers or {}  # register => 16 bit value
+        # register => words; a read starting there returns the record instead,
+        # like the controller's day indexed history
+        self.records = records or {}
+
+    @classmethod
+    def from_profile(cls, device_type, device_id, rng=None):
+        registers, records = PROFILES[device_type](rng or random.Random(), device_id)
+        return cls(registers, records)
+
+    def read(self, register, words, strict=False):
+        record = self.records.get(register)
+        if record is not None:
+            return (record + [0] * words)[:words]
+        if strict and any(
+            r not in self.registers for r in range(register, register + words)
+        ):
+            return None
+        return [self.registers.get(r, 0) for r in range(register, register + words)]
+
+
+class SimulatedModule:
+    def __init__(
+        self,
+        mac_address,
+        name=None,
+        units=None,
+        latency=DEFAULT_LATENCY,
+        jitter=0,
+        fragment=DEFAULT_FRAGMENT,
+        drop_rate=0,
+        rssi=-60,
+        strict=False,
+        seed=None,
+    ):
+        self.device = BLEDevice(
+            mac_address, name or f"BT-TH-{mac_address.replace(':', '')[-8:]}", None
+        )
+        self.units = units or {}  # device_id => SimulatedUnit
+        self.latency = latency
+        self.jitter = jitter
+        self.fragment = fragment
+        self.drop_rate = drop_rate
+        self.rssi = rssi
+        self.strict = strict  # unmapped registers answer with an exception
+        self.rng = random.Random(seed)
+        self.requests = 0
+        self.dropped = 0
+
+    def delay(self):
+        return max(0, self.latency + self.rng.uniform(-self.jitter, self.jitter))
+
+    # Modbus RTU response to a request frame, None when nothing is sent back
+    def respond(self, request):
+        self.requests += 1
+        if len(request) < 8 or crc16_modbus(request[:6]) != request[6:8]:
+            return None
+        if self.drop_rate and self.rng.random() < self.drop_rate:
+            self.dropped += 1
+            return None
+        device_id, function = request[0], request[1]
+        unit = self.units.get(device_id)
+        if unit is None and device_id == 255 and self.units:
+            # a broadcast is answered by the (first) device under its real id
+            device_id, unit = next(iter(self.units.items()))
+        if unit is None:
+            return None
+
+        register = int.from_bytes(request[2:4], "big")
+        value = int.from_bytes(request[4:6], "big")
+        if function == 3:
+            words = unit.read(register, value, self.strict)
+            if words is None:
+                response = bytes([device_id, 0x83, ILLEGAL_ADDRESS])
+            else:
+                body = b"".join(word.to_bytes(2, "big") for word in words)
+                response = bytes([device_id, 3, len(body)]) + body
+        elif function == 6:
+            unit.registers[register] = value
+            response = bytes([device_id]) + request[1:6]
+        else:
+            response = bytes([device_id, function | 0x80, ILLEGAL_FUNCTION])
+        return response + crc16_modbus(response)
+
+    def fragments(self, response):
+        size = self.fragment or len(response)
+        return [response[i : i + size] for i in range(0, len(response), size)]
+
+
+# Quacks like a connected BleakClient for BLEManager
+class SimulatedClient:
+    def __init__(self, module, disconnected_callback=None):
+        self.module = module
+        self.disconnected_callback = disconnected_callback
+        self.services = [_Service()]
+        self.connected = False
+        self.notify_callback = None
+        self.tasks = set()
+
+    @property
+    def is_connected(self):
+        return self.connected
+
+    async def connect(self):
+        await asyncio.sleep(self.module.delay())
+        self.connected = True
+
+    async def disconnect(self):
+        self.__close()
+
+    async def start_notify(self, characteristic, callback):
+        self.notify_callback = callback
+
+    async def write_gatt_char(self, uuid, data):
+        if not self.connected:
+            raise ConnectionError(f"{self.module.device.address} not connected")
+        response = self.module.respond(bytes(data))
+        if response is not None:
+            task = asyncio.create_task(self.__notify(response))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    # Simulates the link going away (out of range, module reset...)
+    def drop_link(self):
+        self.__close()
+
+    def __close(self):
+        if not self.connected:
+            return
+        self.connected = False
+        for task in self.tasks:
+            task.cancel()
+        if self.disconnected_callback:
+            self.disconnected_callback(self)
+
+    async def __notify(self, response):
+        await asyncio.sleep(self.module.delay())
+        for fragment in self.module.fragments(response):
+            if not self.connected:
+                return
+            await self.notify_callback(None, bytearray(fragment))
+
+
+class SimulatedScanner:
+    def __init__(self, backend, detection_callback, interval):
+        self.backend = backend
+        self.detection_callback = detection_callback
+        self.interval = interval
+        self.task = None
+
+    async def start(self):
+        self.task = asyncio.create_task(self.__advertise())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+    async def __advertise(self):
+        while True:
+            for module in list(self.backend.modules.values()):
+                self.detection_callback(module.device, Advertisement(module.rssi))
+            await asyncio.sleep(self.interval)
+
+
+class SimulatorBackend:
+    def __init__(self, modules=None, advertise_interval=1):
+        self.modules = {}  # MAC => SimulatedModule
+        self.clients = []
+        self.advertise_interval = advertise_interval
+        for module in modules or []:
+            self.add(module)
+
+    def add(self, module):
+        self.modules[module.device.address.upper()] = module
+        return module
+
+    def create_client(self, device, adapter=None, disconnected_callback=None):
+        module = self.modules.get(device.address.upper())
+        if module is None:
+            raise ConnectionError(f"No simulated device {device.address}")
+        client = SimulatedClient(module, disconnected_callback)
+        self.clients.append(client)
+        return client
+
+    def create_scanner(self, detection_callback, adapter=None):
+        return SimulatedScanner(self, detection_callback, self.advertise_interval)
+
+    # Adds `count` modules of one device type (several units each with hub_ids)
+    # and returns their config entries for config['devices']
+    def populate(
+        self, count, device_type="RNG_CTRL", hub_ids=(255,), seed=0, **options
+    ):
+        rng = random.Random(seed)
+        devices = []
+        start = len(self.modules)
+        for n in range(start, start + count):
+            mac = f"5A:00:00:00:{n >> 8 & 0xFF:02X}:{n & 0xFF:02X}"
+            module = self.add(SimulatedModule(mac, seed=rng.random(), **options))
+            for device_id in hub_ids:
+                real_id = 1 if device_id == 255 else device_id
+                module.units[real_id] = SimulatedUnit.from_profile(
+                    device_type, real_id, rng
+                )
+                devices.append(
+                    {
+                        "alias": f"{module.device.name}-{device_id}",
+                        "mac_addr": mac,
+                        "type": device_type,
+                        "device_id": device_id,
+                        "bleak_device": module.device,
+                    }
+                )
+        logging.info(f"Simulating {len(self.modules)} bluetooth modules")
+        return devices
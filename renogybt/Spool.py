@@ -0,0 +1,199 @@
+import asyncio
+import json
+import logging
+import os
+import time
+
+# Durable store-and-forward journal of the readings one sink failed to deliver.
+# Readings are appended as json lines to numbered segment files under `path`;
+# a new segment is started every `segment_bytes` and on every start, so a line
+# torn by a crash never gets appended to. Appends are fsynced in batches, at
+# most `fsync_interval` secs after the first unsynced one. The replay position
+# is a (segment, offset) cursor persisted next to the segments, consumed
+# segments are deleted. The journal is bounded by `max_bytes` and `max_age`:
+# beyond either the oldest segments are dropped, replayed or not.
+
+SEGMENT_SUFFIX = ".log"
+CURSOR_FILE = "cursor.json"
+DEFAULT_SEGMENT_BYTES = 1048576
+DEFAULT_MAX_BYTES = 50 * 1048576
+DEFAULT_MAX_AGE = 7 * 86400  # (seconds)
+DEFAULT_FSYNC_INTERVAL = 5  # (seconds)
+
+
+class Spool:
+    def __init__(
+        self,
+        path,
+        max_bytes=DEFAULT_MAX_BYTES,
+        max_age=DEFAULT_MAX_AGE,
+        segment_bytes=DEFAULT_SEGMENT_BYTES,
+        fsync_interval=DEFAULT_FSYNC_INTERVAL,
+    ):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.segment_bytes = segment_bytes
+        self.fsync_interval = fsync_interval
+        os.makedirs(path, exist_ok=True)
+        self.sizes = {  # segment => bytes, oldest first
+            int(name.removesuffix(SEGMENT_SUFFIX)): os.path.getsize(
+                os.path.join(path, name)
+            )
+            for name in sorted(os.listdir(path))
+            if name.endswith(SEGMENT_SUFFIX)
+        }
+        self.cursor = self.load_cursor()
+        self.file = None  # segment being appended to, opened on first append
+        self.segment = max(self.sizes, default=0) + 1
+        self.sync_handle = None
+        self.ready = asyncio.Event()  # set whenever a reading is appended
+        self.expired = 0
+        self.backlog = self.count_backlog()  # readings not replayed yet
+        if self.backlog:
+            self.ready.set()
+
+    def segment_path(self, segment):
+        return os.path.join(self.path, f"{segment:012d}{SEGMENT_SUFFIX}")
+
+    def append(self, json_data):
+        if self.file is None or self.sizes[self.segment] >= self.segment_bytes:
+            self.rotate()
+        line = (
+            json.dumps({"time": time.time(), "data": json_data}, separators=(",", ":"))
+            + "\n"
+        ).encode()
+        self.file.write(line)
+        self.sizes[self.segment] += len(line)
+        self.backlog += 1
+        self.ready.set()
+        if self.sync_handle is None:
+            self.sync_handle = asyncio.get_running_loop().call_later(
+                self.fsync_interval, self.sync
+            )
+        self.enforce_bounds()
+
+    def rotate(self):
+        if self.file is not None:
+            self.sync()
+            self.file.close()
+            self.segment += 1
+        self.file = open(self.segment_path(self.segment), "ab")
+        self.sizes[self.segment] = 0
+
+    def sync(self):
+        if self.sync_handle is not None:
+            self.sync_handle.cancel()
+            self.sync_handle = None
+        if self.file is not None:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    # Up to `limit` readings from the cursor on, as (reading, cursor after it)
+    def read(self, limit):
+        if self.file is not None:
+            self.file.flush()
+        entries = []
+        segment, offset = self.cursor
+        for current in self.sizes:
+            if current < segment:
+                continue
+            with open(self.segment_path(current), "rb") as f:
+                f.seek(offset if current == segment else 0)
+                while len(entries) < limit:
+                    line = f.readline()
+                    if not line.endswith(b"\n"):  # end of segment or torn line
+                        break
+                    position = (current, f.tell())
+                    try:
+                        entries.append((json.loads(line)["data"], position))
+                    except ValueError:
+                        logging.warning(f"Skipping corrupt spool entry in {f.name}")
+                        self.cursor = position
+            if len(entries) >= limit:
+                break
+        return entries
+
+    # Marks everything up to `cursor` as delivered
+    def commit(self, cursor, count):
+        self.cursor = cursor
+        self.backlog = max(0, self.backlog - count)
+        for segment in list(self.sizes):
+            if segment < cursor[0] and segment != self.segment:
+                self.remove(segment)
+        self.save_cursor()
+
+    def backlog_bytes(self):
+        segment, offset = self.cursor
+        return sum(
+            size - (offset if current == segment else 0)
+            for current, size in self.sizes.items()
+            if current >= segment
+        )
+
+    # Drops the oldest segments beyond max_bytes or older than max_age
+    def enforce_bounds(self):
+        total = sum(self.sizes.values())
+        now = time.time()
+        for segment in list(self.sizes):
+            if segment == self.segment:
+                break
+            path = self.segment_path(segment)
+            if total <= self.max_bytes and now - os.path.getmtime(path) < self.max_age:
+                break
+            dropped = self.count_lines(segment)
+            logging.warning(
+                f"Spool {self.path}: dropping {dropped} undelivered readings"
+            )
+            self.expired += dropped
+            self.backlog = max(0, self.backlog - dropped)
+            total -= self.sizes[segment]
+            self.remove(segment)
+            if self.cursor[0] <= segment:
+                self.cursor = (segment + 1, 0)
+                self.save_cursor()
+
+    def remove(self, segment):
+        try:
+            os.remove(self.segment_path(segment))
+        except FileNotFoundError:
+            pass
+        del self.sizes[segment]
+
+    # readings of a segment not yet replayed
+    def count_lines(self, segment):
+        current, offset = self.cursor
+        if segment < current:
+            return 0
+        with open(self.segment_path(segment), "rb") as f:
+            f.seek(offset if segment == current else 0)
+            return f.read().count(b"\n")
+
+    def count_backlog(self):
+        return sum(self.count_lines(segment) for segment in self.sizes)
+
+    def load_cursor(self):
+        try:
+            with open(os.path.join(self.path, CURSOR_FILE)) as f:
+                segment, offset = json.load(f)
+            return (segment, offset)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logging.warning(f"Ignoring unreadable spool cursor in {self.path}: {e}")
+        return (min(self.sizes, default=0), 0)
+
+    def save_cursor(self):
+        path = os.path.join(self.path, CURSOR_FILE)
+        try:
+            with open(f"{path}.tmp", "w") as f:
+                json.dump(list(self.cursor), f)
+            os.replace(f"{path}.tmp", path)
+        except Exception as e:
+            logging.warning(f"Could not save spool cursor {path}: {e}")
+
+    def close(self):
+        if self.file is not None:
+            self.sync()
+            self.file.close()
+            self.file = None
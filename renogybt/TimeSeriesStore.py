@@ -0,0 +1,325 @@
+import json
+import logging
+import math
+import mmap
+import os
+import re
+import struct
+import time
+from dataclasses import fields as dataclass_fields
+
+# Local history of the numeric fields of every reading, one ring file per device
+# under `path`. A file holds fixed-width records (float64 timestamp + one float32
+# per column, NaN when a field was missing) behind a small header, is created at
+# its full size (`max_bytes`) and memory-mapped, so an append is a struct write
+# into the mapping and the oldest record is overwritten once the file is full.
+# Columns are fixed when the file is created: the numeric fields of the device
+# type's reading class plus the numeric fields of the first reading (e.g. the
+# battery's cell_voltage_0...). Dirty pages are flushed every `flush_interval`
+# secs instead of per reading to spare the SD card.
+# Records are kept in append order and found by bisecting their timestamps. When
+# the clock steps back (e.g. NTP sync on a Pi without RTC) the file is flagged
+# unordered and queries scan it linearly, until the out of order records have
+# been overwritten.
+# Queries read records straight from the mapping:
+#   store.range("BT-TH-1234", start, end, fields=["pv_power"])
+#   store.downsample("BT-TH-1234", start, end, bucket=3600)
+
+MAGIC = b"RBTS"
+VERSION = 1
+# magic, version, flags, header size, record size, capacity, head, count;
+# followed by the length of the column names and the names as json
+HEADER = struct.Struct("<4sHHIIIII")
+FLAGS_OFFSET = 6
+HEAD_OFFSET = HEADER.size - 8
+COUNT_OFFSET = HEADER.size - 4
+WORD = struct.Struct("<I")
+FLAGS = struct.Struct("<H")
+UNORDERED = 1  # flag: some timestamps are lower than the one before
+DEFAULT_MAX_BYTES = 1048576  # per device file
+DEFAULT_FLUSH_INTERVAL = 60  # (seconds)
+NUMERIC_TYPES = (int, float)
+PRECISION = 4  # decimals returned, hides float32 noise (3.3 => 3.2999999523)
+
+
+def numeric_columns(reading_class, data=None):
+    columns = []
+    if reading_class is not None:
+        types = {f.name: f.type for f in dataclass_fields(reading_class)}
+        for attribute, key in reading_class.KEYS:
+            if any(t in str(types.get(attribute)) for t in ("int", "float")):
+                columns.append(key)
+    for key, value in (data or {}).items():
+        if key not in columns and is_number(value):
+            columns.append(key)
+    return columns
+
+
+def is_number(value):
+    return isinstance(value, NUMERIC_TYPES) and not isinstance(value, bool)
+
+
+class RingFile:
+    def __init__(self, path, columns=None, max_bytes=DEFAULT_MAX_BYTES):
+        self.path = path
+        if os.path.isfile(path):
+            self.open_existing()
+        elif columns:
+            self.create(columns, max_bytes)
+        else:
+            raise FileNotFoundError(path)
+        self.index = {column: i for i, column in enumerate(self.columns)}
+
+    def create(self, columns, max_bytes):
+        names = json.dumps(columns).encode()
+        header_size = HEADER.size + WORD.size + len(names)
+        header_size += -header_size % 8
+        record = struct.Struct(f"<d{len(columns)}f")
+        capacity = (max_bytes - header_size) // record.size
+        if capacity < 1:
+            raise ValueError(
+                f"max_bytes {max_bytes} too small for {len(columns)} columns"
+            )
+        with open(self.path, "wb") as f:
+            f.truncate(header_size + capacity * record.size)
+            f.write(
+                HEADER.pack(MAGIC, VERSION, 0, header_size, record.size, capacity, 0, 0)
+            )
+            f.write(WORD.pack(len(names)) + names)
+        self.open_existing()
+
+    def open_existing(self):
+        self.file = open(self.path, "r+b")
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        magic, version, _, self.header_size, record_size, self.capacity, _, _ = (
+            HEADER.unpack_from(self.map, 0)
+        )
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ValueError(f"{self.path} is not a time series file")
+        (length,) = WORD.unpack_from(self.map, HEADER.size)
+        start = HEADER.size + WORD.size
+        self.columns = json.loads(self.map[start : start + length])
+        self.record = struct.Struct(f"<d{len(self.columns)}f")
+        if self.record.size != record_size:
+            self.close()
+            raise ValueError(f"{self.path} has a corrupt header")
+
+    @property
+    def head(self):
+        return WORD.unpack_from(self.map, HEAD_OFFSET)[0]
+
+    @property
+    def count(self):
+        return WORD.unpack_from(self.map, COUNT_OFFSET)[0]
+
+    @property
+    def ordered(self):
+        return not FLAGS.unpack_from(self.map, FLAGS_OFFSET)[0] & UNORDERED
+
+    def set_ordered(self, ordered):
+        flags = FLAGS.unpack_from(self.map, FLAGS_OFFSET)[0]
+        flags = flags & ~UNORDERED if ordered else flags | UNORDERED
+        FLAGS.pack_into(self.map, FLAGS_OFFSET, flags)
+
+    def append(self, timestamp, values):
+        head, count = self.head, self.count
+        if count and self.ordered and timestamp < self.timestamp(count - 1):
+            logging.warning(
+                f"{self.path}: clock went back, queries scan the file linearly"
+            )
+            self.set_ordered(False)
+        self.record.pack_into(
+            self.map, self.header_size + head * self.record.size, timestamp, *values
+        )
+        # the record is written before the header points at it
+        WORD.pack_into(self.map, HEAD_OFFSET, (head + 1) % self.capacity)
+        WORD.pack_into(self.map, COUNT_OFFSET, min(count + 1, self.capacity))
+        # once per pass over the file, the out of order records may be gone
+        if head + 1 == self.capacity and not self.ordered:
+            self.set_ordered(self.in_order())
+
+    # i-th record in time order, 0 is the oldest
+    def offset(self, i):
+        slot = (self.head - self.count + i) % self.capacity
+        return self.header_size + slot * self.record.size
+
+    def timestamp(self, i):
+        return struct.unpack_from("<d", self.map, self.offset(i))[0]
+
+    def read(self, i):
+        return self.record.unpack_from(self.map, self.offset(i))
+
+    # index of the first record at or after `timestamp`
+    def bisect(self, timestamp):
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.timestamp(middle) < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def in_order(self):
+        timestamps = [self.timestamp(i) for i in range(self.count)]
+        return all(a <= b for a, b in zip(timestamps, timestamps[1:]))
+
+    # Records with start <= time < end in time order
+    def scan(self, start=None, end=None):
+        if not self.ordered:
+            yield from sorted(
+                (
+                    record
+                    for record in map(self.read, range(self.count))
+                    if (start is None or record[0] >= start)
+                    and (end is None or record[0] < end)
+                ),
+                key=lambda record: record[0],
+            )
+            return
+        i = 0 if start is None else self.bisect(start)
+        count = self.count
+        while i < count:
+            record = self.read(i)
+            if end is not None and record[0] >= end:
+                return
+            yield record
+            i += 1
+
+    def flush(self):
+        self.map.flush()
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+class TimeSeriesStore:
+    def __init__(
+        self,
+        path="timeseries",
+        max_bytes=DEFAULT_MAX_BYTES,
+        flush_interval=DEFAULT_FLUSH_INTERVAL,
+    ):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.flush_interval = flush_interval
+        self.files = {}  # device => RingFile
+        self.last_flush = time.monotonic()
+        os.makedirs(path, exist_ok=True)
+
+    def file_path(self, device):
+        return os.path.join(self.path, re.sub(r"[^\w.-]+", "_", device) + ".ring")
+
+    def ring(self, device, reading_class=None, data=None):
+        ring = self.files.get(device)
+        if ring is None:
+            path = self.file_path(device)
+            if data is None and not os.path.isfile(path):
+                return None
+            ring = RingFile(path, numeric_columns(reading_class, data), self.max_bytes)
+            self.files[device] = ring
+        return ring
+
+    # Stores the numeric fields of a reading, timestamped now unless given
+    def append(self, data, reading_class=None, timestamp=None):
+        device = data.get("__device")
+        if device is None:
+            return
+        try:
+            ring = self.ring(device, reading_class, data)
+            values = [
+                value if is_number(value := data.get(column)) else math.nan
+                for column in ring.columns
+            ]
+            ring.append(time.time() if timestamp is None else timestamp, values)
+        except Exception as e:
+            logging.warning(f"Time series store: could not store {device}: {e}")
+            return
+        if time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    # Records with start <= time < end as dicts ('time' plus the requested fields)
+    def range(self, device, start=None, end=None, fields=None):
+        ring = self.ring(device)
+        if ring is None:
+            return []
+        columns = self.columns(ring, fields)
+        return [
+            {
+                "time": record[0],
+                **{
+                    column: round(record[i + 1], PRECISION)
+                    for column, i in columns
+                    if not math.isnan(record[i + 1])
+                },
+            }
+            for record in ring.scan(start, end)
+        ]
+
+    # min/max/mean of each field per `bucket` secs (aligned to the epoch)
+    def downsample(self, device, start=None, end=None, bucket=3600, fields=None):
+        ring = self.ring(device)
+        if ring is None:
+            return []
+        columns = self.columns(ring, fields)
+        buckets = []
+        current = None
+        for record in ring.scan(start, end):
+            bucket_start = record[0] - record[0] % bucket
+            if current is None or current["time"] != bucket_start:
+                current = {"time": bucket_start, "count": 0, "stats": {}}
+                buckets.append(current)
+            current["count"] += 1
+            for column, i in columns:
+                value = record[i + 1]
+                if math.isnan(value):
+                    continue
+                stats = current["stats"].get(column)
+                if stats is None:
+                    current["stats"][column] = [value, value, value, 1]
+                else:
+                    stats[0] = min(stats[0], value)
+                    stats[1] = max(stats[1], value)
+                    stats[2] += value
+                    stats[3] += 1
+        return [
+            {
+                "time": b["time"],
+                "count": b["count"],
+                **{
+                    column: {
+                        "min": round(low, PRECISION),
+                        "max": round(high, PRECISION),
+                        "mean": round(total / n, PRECISION),
+                    }
+                    for column, (low, high, total, n) in b["stats"].items()
+                },
+            }
+            for b in buckets
+        ]
+
+    def devices(self):
+        return sorted(
+            name.removesuffix(".ring")
+            for name in os.listdir(self.path)
+            if name.endswith(".ring")
+        )
+
+    @staticmethod
+    def columns(ring, fields):
+        if fields is None:
+            return [(column, i) for i, column in enumerate(ring.columns)]
+        return [(f, ring.index[f]) for f in fields if f in ring.index]
+
+    def flush(self):
+        for ring in self.files.values():
+            ring.flush()
+        self.last_flush = time.monotonic()
+
+    def close(self):
+        for ring in self.files.values():
+            ring.flush()
+            ring.close()
+        self.files = {}
@@ -3,4 +3,15 @@ from .DataLogger import DataLogger
 from .BatteryClient import BatteryClient
 from .RoverHistoryClient import RoverHistoryClient
 from .InverterClient import InverterClient
+from .DeviceScanner import DeviceScanner
+from .AdapterPool import AdapterPool
+from .PollScheduler import PollScheduler
+from .SectionCache import SectionCache
+from .HistoryStore import HistoryStore
+from .EnergyIntegrator import EnergyIntegrator
+from .BatteryBank import BankAggregator
+from .Metrics import MetricsServer
+from .Readings import Reading
+from .TimeSeriesStore import TimeSeriesStore
+from .Simulator import SimulatorBackend, SimulatedModule, SimulatedUnit
 from .Utils import *